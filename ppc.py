@@ -11,96 +11,1815 @@ Jonas Lindeløv
 
 TO DO:
  * add UTC times in csvWriter?
- * Remove sound or make it a dummy-one which drops back to psychopy
  * Use PEP8 names instead of camelCase
 """
 
 # Check python version
+import collections
+import math
 import sys
 python3 = sys.version_info[0] == 3
 
+# The most precise clock for measuring durations on this platform and python version
+from timeit import default_timer as _clock
+try:
+    from time import perf_counter_ns as _clock_ns  # python 3.7+. Integer nanoseconds.
+except ImportError:
+    def _clock_ns():
+        return int(_clock() * 10**9)
+
+
+def _percentile(values, percent):
+    """Returns the percent'th percentile (0-100) of a sorted list, interpolating between neighbours."""
+    if not values:
+        return float('nan')
+    k = (len(values) - 1) * percent / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def _mean_sd(values):
+    """Returns the mean and the sample standard deviation of a list"""
+    if not values:
+        return float('nan'), float('nan')
+    mean = sum(values) / float(len(values))
+    if len(values) < 2:
+        return mean, float('nan')
+    return mean, (sum((value - mean) ** 2 for value in values) / (len(values) - 1)) ** 0.5
+
+
+def _betainc(a, b, x):
+    """The regularized incomplete beta function, using the continued fraction from Numerical Recipes"""
+    if x <= 0 or x >= 1:
+        return max(0.0, min(1.0, x))
+    if x > (a + 1) / (a + b + 2):  # the continued fraction converges fast on this side
+        return 1 - _betainc(b, a, 1 - x)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x)) / a
+
+    # Lentz's algorithm
+    tiny = 1e-300
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 300):
+        for numerator in [m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))]:
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            result *= c * d
+        if abs(c * d - 1) < 1e-12:
+            break
+    return front * result
+
+
+def _t_cdf(t, df):
+    """The cumulative distribution function of Student's t distribution"""
+    tail = 0.5 * _betainc(df / 2.0, 0.5, df / (df + t * t))
+    return 1 - tail if t > 0 else tail
+
+
+def _t_ppf(q, df):
+    """The inverse of _t_cdf, found by bisection"""
+    low, high = -1e3, 1e3
+    for i in range(100):
+        middle = (low + high) / 2
+        if _t_cdf(middle, df) < q:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def _time_scale(duration):
+    """Returns the timeScale (s, ms, us or ns) appropriate for reporting a duration"""
+    return 1 if duration > 1 else 10**-3 if duration > 10**-3 else 10**-6 if duration > 10**-6 else 10**-9
+
+
+def _unit(timeScale):
+    """Returns the name of a timeScale"""
+    return 's' if timeScale == 1 else 'ms' if timeScale == 10**-3 else 'us' if timeScale == 10**-6 else 'ns' if timeScale == 10**-9 else '*' + str(timeScale)
+
+
+class _BackgroundWriter(object):
+    """
+    Hands items over to a dedicated thread which calls write_batch(items) on
+    whatever has accumulated since the last batch. put() only enqueues, so
+    file I/O never happens on the thread that called it.
+    """
+    _STOP = object()
+
+    def __init__(self, write_batch, queue_size=1000, batch_size=100, latency_samples=10000):
+        """
+        :write_batch: function taking a list of items. Called on the writer thread.
+        :queue_size: maximum number of items waiting. put() blocks if the writer thread falls this far behind.
+        :batch_size: maximum number of items handed to write_batch at once.
+        :latency_samples: how many of the most recent put() durations to keep for stats().
+        """
+        import threading
+        self._queue = __import__('queue' if python3 else 'Queue').Queue(queue_size)
+        self._write_batch = write_batch
+        self._batch_size = batch_size
+        self._latencies = [0.0] * latency_samples  # preallocated ring buffer
+        self._new_event = threading.Event
+        self._event_type = type(threading.Event())
+        self.puts = 0
+        self.high_water = 0
+        self.error = None
+
+        self._thread = threading.Thread(target=self._run, name='ppc writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        """Enqueues an item and records how long that took."""
+        if self.error is not None:
+            raise self.error
+        start = _clock()
+        self._queue.put(item)
+        self._latencies[self.puts % len(self._latencies)] = _clock() - start
+        self.puts += 1
+        size = self._queue.qsize()
+        if size > self.high_water:
+            self.high_water = size
+
+    def wait(self):
+        """Blocks until everything enqueued so far has been written."""
+        event = self._new_event()
+        self._queue.put(event)
+        while not event.wait(0.1):  # a timeout keeps the wait interruptible
+            if not self._thread.is_alive():
+                break
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Waits for all enqueued items to be written and stops the thread. An error of the thread is raised by the first close() only."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+            if self.error is not None:
+                raise self.error
+
+    def stats(self):
+        """Returns a dict with queue high-water mark and put() latency percentiles in seconds."""
+        latencies = sorted(self._latencies[:min(self.puts, len(self._latencies))])
+        return {
+            'writes': self.puts,
+            'queue_size': self._queue.maxsize,
+            'queue_high_water': self.high_water,
+            'enqueue_median': _percentile(latencies, 50),
+            'enqueue_p95': _percentile(latencies, 95),
+            'enqueue_p99': _percentile(latencies, 99),
+            'enqueue_max': latencies[-1] if latencies else float('nan')
+        }
+
+    def _run(self):
+        """The writer thread: block for the first item, then grab whatever else is waiting."""
+        get, get_nowait = self._queue.get, self._queue.get_nowait
+        empty = __import__('queue' if python3 else 'Queue').Empty
+        while True:
+            batch = [get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(get_nowait())
+                except empty:
+                    break
+
+            # Separate the items from waiting events and the stop signal
+            events = [item for item in batch if type(item) is self._event_type]
+            if events:
+                batch = [item for item in batch if type(item) is not self._event_type]
+            stop = bool(batch) and batch[-1] is self._STOP
+            if stop:
+                batch.pop()
+
+            if batch and self.error is None:
+                try:
+                    self._write_batch(batch)
+                except Exception as error:  # re-raised on the experiment thread by put(), wait() or close()
+                    self.error = error
+            for event in events:
+                event.set()
+            if stop:
+                return
+
+
+def _read_wav(filename):
+    """Returns (samples, rate) of a .wav file. samples is a float32 array of shape (frames, channels) from -1 to 1."""
+    import wave
+    import numpy as np
+    wav = wave.open(filename, 'rb')
+    try:
+        channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        data = wav.readframes(wav.getnframes())
+    finally:
+        wav.close()
+
+    if width == 1:  # unsigned 8 bit
+        samples = (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    elif width == 3:  # 24 bit. Put the bytes in the top of an int32.
+        raw = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)).astype(np.float32) / 2 ** 31
+    else:  # signed 16 or 32 bit
+        samples = np.frombuffer(data, '<i%i' % width).astype(np.float32) / 2 ** (8 * width - 1)
+    return samples.reshape(-1, channels), rate
+
+
+def _write_wav(target, samples, rate):
+    """Writes samples (frames, channels) from -1 to 1 as a 16 bit .wav to a filename or a file object."""
+    import wave
+    import numpy as np
+    wav = wave.open(target, 'wb')
+    try:
+        wav.setnchannels(samples.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+    finally:
+        wav.close()
+
+
+class _SoundDeviceOutput(object):
+    """
+    Plays through a sounddevice (PortAudio) stream which is kept open.
+    play() only hands over the buffer. The stream's callback copies it to the
+    sound card and records when it starts.
+    """
+    def __init__(self, rate, channels):
+        import sounddevice  # raises OSError if the PortAudio library is missing
+        self.last_start = None  # estimated onset of the last sound on ppc's clock
+        self._playing = None  # [samples, position]. Replaced as a whole, so handing over is atomic.
+        try:
+            self._stream = sounddevice.OutputStream(samplerate=rate, channels=channels, dtype='float32', latency='low', callback=self._callback)
+            self._stream.start()
+        except sounddevice.PortAudioError as error:  # e.g. no output device
+            raise OSError('PortAudio could not open an output stream: %s' % error)
+
+    def play(self, samples, filename=None):
+        self._playing = [samples, 0]
+
+    def stop(self):
+        self._playing = None
+
+    def _callback(self, outdata, frames, time_info, status):
+        playing = self._playing
+        if playing is None or playing[1] >= len(playing[0]):
+            outdata.fill(0)
+            return
+        samples, position = playing
+        chunk = samples[position:position + frames]
+        outdata[:len(chunk)] = chunk
+        outdata[len(chunk):] = 0
+        if position == 0:  # first buffer. It is heard when the sound card gets to it.
+            self.last_start = _clock() + time_info.outputBufferDacTime - time_info.currentTime
+        playing[1] = position + frames
+
+
+class _WinsoundOutput(object):
+    """
+    Plays through winsound (Windows only). Sounds from files are played by
+    Windows directly. Generated sounds are played from memory on a thread
+    because winsound can't play from memory asynchronously. The onset is unknown.
+    """
+    def __init__(self, rate, channels):
+        import winsound
+        self.last_start = None
+        self._winsound = winsound
+        self._rate = rate
+        self._memory = {}  # id(samples) --> (samples, wav bytes)
+
+    def play(self, samples, filename=None):
+        winsound = self._winsound
+        if filename:
+            winsound.PlaySound(filename, winsound.SND_FILENAME | winsound.SND_ASYNC | winsound.SND_NODEFAULT)
+            return
+
+        import io
+        import threading
+        if id(samples) not in self._memory:
+            data = io.BytesIO()
+            _write_wav(data, samples, self._rate)
+            self._memory[id(samples)] = (samples, data.getvalue())  # keep samples alive so the id isn't reused
+        thread = threading.Thread(target=winsound.PlaySound, args=(self._memory[id(samples)][1], winsound.SND_MEMORY))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._winsound.PlaySound(None, 0)
+
+
+class _NullOutput(object):
+    """
+    Plays nothing but records what would have been played, for testing
+    without a sound card. played holds (time, samples) of the last 10000
+    sounds. write() saves them to a .wav file.
+    """
+    def __init__(self, rate, channels):
+        self.last_start = None
+        self.played = collections.deque(maxlen=10000)
+        self._rate = rate
+        self._channels = channels
+
+    def play(self, samples, filename=None):
+        self.last_start = _clock()
+        self.played.append((self.last_start, samples))
+
+    def stop(self):
+        pass
+
+    def write(self, filename):
+        """Writes everything played so far to a .wav file, one sound after the other."""
+        import numpy as np
+        samples = np.concatenate([samples for time, samples in self.played]) if self.played else np.zeros((0, self._channels))
+        _write_wav(filename, samples, self._rate)
+
+
+_sound_backends = collections.OrderedDict([('sounddevice', _SoundDeviceOutput), ('winsound', _WinsoundOutput), ('null', _NullOutput)])
+_sound_outputs = {}  # (backend, rate, channels) --> output. Shared by sounds.
+
+
+def _sound_output(backend, rate, channels):
+    """Returns an output for the backend name, or the first one which can be imported if backend is None."""
+    if backend is not None and not isinstance(backend, str):
+        return backend  # your own output with play(samples, filename) and stop()
+    names = [backend] if backend else [name for name in _sound_backends if name != 'null']
+    errors = []
+    for name in names:
+        key = (name, rate, channels)
+        if key not in _sound_outputs:
+            try:
+                _sound_outputs[key] = _sound_backends[name](rate, channels)
+            except (ImportError, OSError) as error:  # not installed, or no library or device
+                errors.append('%s: %s' % (name, error))
+                continue
+        return _sound_outputs[key]
+    raise ImportError('No sound backend could be used (%s). Install sounddevice or use backend="null" for testing.' % '; '.join(errors))
+
 
 class Sound(object):
     """
-    A windows-only low-latency replacement for psychopy.sound.
-    It can only play wav files. Timing is unreliable if sound.play() is called
-    before previous sound ends. Usage::
+    A low-latency replacement for psychopy.sound. It can only play wav files
+    and generated beeps. The file is decoded once when the Sound is created,
+    so play() only hands a buffer to the sound card. It's fast enough for
+    win.callOnFlip(). Playing a sound stops the sound playing at the same
+    sample rate. Usage::
+
+        beep = ppc.Sound('beep.wav')
+        beep.play()
+
+        # or generated beep:
+        beep = ppc.Sound()
+        beep.beep(1000, 0.2)  # 1000 Hz for 0.2 seconds
+
+    :filename: a .wav file
+    :backend: where the sound goes. 'sounddevice' (all platforms, needs the
+        sounddevice package), 'winsound' (Windows only) or 'null' (plays
+        nothing but records it in sound.backend.played for testing). You can
+        also pass your own object with play(samples, filename) and stop().
+        Default: the first of sounddevice and winsound which works.
+    :rate: sample rate in Hz of beeps when there's no file.
+    """
+    def __init__(self, filename='', backend=None, rate=44100):
+        self.filename = filename
+        if filename:
+            self.samples, self.rate = _read_wav(filename)
+        else:
+            self.samples, self.rate = None, rate
+        self.channels = self.samples.shape[1] if filename else 1
+        self.backend = _sound_output(backend, self.rate, self.channels)
+        self.last_call = None  # time of the last call to play()
+        self._tones = {}  # (frequency, duration, volume) --> samples
+
+    def play(self):
+        """ plays the sound file with low latency"""
+        if self.samples is None:
+            raise ValueError('This Sound has no file. Use beep() to play a generated sound.')
+        self.last_call = _clock()
+        self.backend.play(self.samples, self.filename)
+
+    def stop(self):
+        """ stops playing"""
+        self.backend.stop()
+
+    def beep(self, frequency, duration, volume=0.5):
+        """ plays a beep of frequency Hz for duration seconds with low latency"""
+        tone = self._tone(frequency, duration, volume)
+        self.last_call = _clock()
+        self.backend.play(tone, None)
+
+    def _tone(self, frequency, duration, volume):
+        """Returns the samples of a beep. Generated once."""
+        key = (frequency, duration, volume)
+        if key not in self._tones:
+            import numpy as np
+            time = np.arange(int(duration * self.rate)) / float(self.rate)
+            tone = volume * np.sin(2 * np.pi * frequency * time)
+            ramp = min(len(tone) // 2, int(0.005 * self.rate))  # 5 ms fade in and out to avoid clicks
+            if ramp:
+                tone[:ramp] *= np.linspace(0, 1, ramp)
+                tone[-ramp:] *= np.linspace(1, 0, ramp)
+            self._tones[key] = np.repeat(tone.astype(np.float32)[:, None], self.channels, axis=1)
+        return self._tones[key]
+
+    def latency(self, repeats=10, verbose=True):
+        """
+        Plays the sound repeats times and measures how long play() takes
+        (handoff) and the time from calling play() until the sound starts
+        (latency). The latter is only known for the sounddevice and null
+        backends. Without a file, a beep is used. Returns a dict with lists of seconds.
+        """
+        import time
+        samples, filename = self.samples, self.filename
+        if samples is None:
+            samples = self._tone(1000, 0.1, 0.5)
+        result = {'handoff': [], 'latency': []}
+        for i in range(repeats):
+            self.backend.last_start = None
+            start = _clock()
+            self.backend.play(samples, filename)
+            result['handoff'].append(_clock() - start)
+            time.sleep(len(samples) / float(self.rate) + 0.05)  # let it finish
+            if self.backend.last_start is not None:
+                result['latency'].append(self.backend.last_start - start)
+        if verbose:
+            handoff = sorted(result['handoff'])
+            print('play() took %.1f us (median) and %.1f us (max)' % (_percentile(handoff, 50) * 1e6, handoff[-1] * 1e6))
+            if result['latency']:
+                latency = sorted(result['latency'])
+                print('the sound started %.2f ms (median) and %.2f ms (max) after play()' % (_percentile(latency, 50) * 1000, latency[-1] * 1000))
+        return result
+
+
+class _CallTimer(object):
+    """
+    Works like timeit.Timer but times calls of a function in a loop with
+    everything bound to local variables. With func=None, it times the empty loop.
+    """
+    def __init__(self, func, args=(), kwargs=None, keep_gc=False):
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.keep_gc = keep_gc
+
+    def __str__(self):
+        return getattr(self.func, '__name__', repr(self.func)) + '()'
+
+    def timeit(self, number=1000000):
+        """Returns the duration in seconds of number calls."""
+        import gc
+        import itertools
+        func, args, kwargs = self.func, self.args, self.kwargs
+        loop = itertools.repeat(None, number)  # cheaper than range()
+        gc_enabled = gc.isenabled()
+        if not self.keep_gc:
+            gc.disable()  # like timeit.Timer
+        try:
+            start = _clock()
+            if func is None:
+                for _ in loop:
+                    pass
+            elif kwargs:
+                for _ in loop:
+                    func(*args, **kwargs)
+            else:
+                for _ in loop:
+                    func(*args)
+            return _clock() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def repeat(self, repeat=5, number=1000000):
+        """Returns a list of durations of repeat batches of number calls."""
+        return [self.timeit(number) for i in range(repeat)]
+
+
+class Benchmark(object):
+    """
+    A timing session for timing many code snippets back to back. The
+    computer is warmed up once per session and the baseline (the duration
+    of an empty script) is measured once per setup, so each timing only
+    costs the timing itself. ppc.timer() uses a shared session. Usage::
+
+        bench = ppc.Benchmark()
+        bench.timer('stim.text = "hi"', 'stim')
+        bench.timer('stim.pos = (1, 1)', 'stim')
+    """
+    def __init__(self):
+        self._warmed_up = False
+        self._baselines = {}  # setup --> seconds per run of an empty script
+        self._timers = {}  # (script, setup) --> compiled timeit.Timer
+
+    def warm_up(self):
+        """Gets the computer's attention/ressources. First run is slower. Only done once per session."""
+        if not self._warmed_up:
+            import timeit
+            timeit.timeit(number=10**7)
+            self._warmed_up = True
+
+    def _timer(self, script, setup):
+        """
+        Returns a compiled timeit.Timer. setup is a comma-separated string of
+        names to import from __main__ or a dict of variables (python 3 only).
+        If script is a function, it returns a _CallTimer calling it without arguments.
+        """
+        if isinstance(script, _CallTimer):
+            return script
+        key = (script, id(setup) if isinstance(setup, dict) else setup)
+        if key not in self._timers:
+            import timeit
+            if callable(script):
+                self._timers[key] = _CallTimer(script)
+            elif isinstance(setup, dict):
+                self._timers[key] = timeit.Timer(script, globals=setup)
+            else:
+                self._timers[key] = timeit.Timer(script, setup='from __main__ import ' + setup if setup else '')
+        return self._timers[key]
+
+    def baseline(self, setup='', call=False):
+        """
+        Returns the duration in seconds of one run of an empty script with this setup. Cached per setup.
+        If call is True, it's the duration of one iteration of the empty loop used to time functions.
+        """
+        key = '<call>' if call else '<dict>' if isinstance(setup, dict) else setup  # an empty script doesn't use the variables
+        if key not in self._baselines:
+            self.warm_up()
+            runs = 10**6
+            timer = _CallTimer(None) if call else self._timer('pass', setup)
+            self._baselines[key] = timer.timeit(number=runs) / runs
+        return self._baselines[key]
+
+    def runs_for(self, script, setup='', duration=3):
+        """
+        Returns a number of runs from 3 test runs, trying to keep the total test
+        duration around a second but at least 10 runs and at most 10**6 runs.
+        """
+        result = self._timer(script, setup).timeit(number=3)
+        runs = int(duration / result) if result > 0 else 10 ** 6
+        return min(max(runs, 10), 10 ** 6)  # between ten and a million
+
+    def timer(self, script, setup='', timeScale=False, runs=False):
+        """
+        Times code snippets and prints average duration. Returns it in seconds.
+        The arguments are the same as for ppc.timer().
+        """
+        self.warm_up()
+        baseline = self.baseline(setup, isinstance(script, _CallTimer) or callable(script))
+
+        # optional: determine appropriate number of runs from 3 test runs
+        if not runs:
+            runs = self.runs_for(script, setup)
+
+        # Actually do the timing
+        result = self._timer(script, setup).timeit(number=runs)  # Run the test!
+        mean = result / runs - baseline  # in seconds
+
+        # Optional: determine appropriate timeScale for reporting
+        if not timeScale:
+            timeScale = _time_scale(mean)
+        unit = _unit(timeScale)
+
+        # Print results
+        print('\n\'', script if isinstance(script, str) else _CallTimer(script), '\'')
+        print('AVERAGE:', round(mean / timeScale, 3), unit, 'from', runs, 'runs')
+        return mean
+
+    def calibrate(self, script, setup='', batch_duration=0.02):
+        """Returns the number of runs it takes to run script for about batch_duration seconds."""
+        timer = self._timer(script, setup)
+        runs = 1
+        while True:
+            duration = timer.timeit(number=runs)
+            if duration >= batch_duration / 5 or runs >= 10**7:
+                return max(int(runs * batch_duration / duration), 1) if duration > 0 else runs
+            runs *= 10
+
+    def measure(self, script, setup='', runs=False, repeat=20, timeScale=False, confidence=0.95, precision=None, budget=10, memory=False):
+        """
+        Times a code snippet in repeated batches and returns a TimerResult
+        with the distribution of durations. Nothing is printed.
+
+        :script: a string to be timed. Or a function which is called without arguments, e.g. a
+            closure or a bound method. See also measure_call().
+        :setup: a comma-separated string specifying methods and variables to be imported from __main__.
+            Or a dict of the variables used in script, e.g. {'stim': stim}.
+        :runs: the number of runs per batch. If False, it's determined like in timer(), split over the batches.
+            The durations are averages within each batch, so use runs=1 for the distribution of
+            individual runs of slow scripts (> 10 us).
+        :repeat: the number of batches. With precision, the minimum number of batches.
+        :timeScale: the unit for reporting. If False, it's determined from the median.
+        :confidence: the level of the confidence interval of the mean.
+        :precision: (float) if given, keep adding batches until the confidence
+            interval of the mean is within +/- precision of the mean, e.g.
+            0.02 for 2%. Fast and stable scripts then finish quickly and noisy
+            ones get more batches. Each batch lasts about 20 ms unless runs is given.
+            result.converged tells whether the precision was reached.
+        :budget: (float) with precision, stop adding batches after this many seconds.
+        :memory: (bool) also measure allocations and garbage collections in a
+            separate batch after the timing. See profile_memory(). The result is in result.memory.
+        """
+        self.warm_up()
+        baseline = self.baseline(setup, isinstance(script, _CallTimer) or callable(script))
+        timer = self._timer(script, setup)
+
+        # Fixed number of batches
+        if not precision:
+            if not runs:
+                runs = max(self.runs_for(script, setup) // repeat, 1)
+            batches = timer.repeat(repeat, runs)
+            result = TimerResult(script, [batch / runs - baseline for batch in batches], runs, timeScale, confidence)
+
+        # Sequential sampling: add batches until precise enough or out of time
+        else:
+            if not runs:
+                runs = self.calibrate(script, setup)
+            samples, converged, start = [], False, _clock()
+            while not converged and _clock() - start < budget:
+                samples.append(timer.timeit(number=runs) / runs - baseline)
+                if len(samples) >= max(repeat, 2):
+                    mean, sd = _mean_sd(samples)
+                    margin = _t_ppf(0.5 + confidence / 2, len(samples) - 1) * sd / len(samples) ** 0.5
+                    converged = mean > 0 and margin <= precision * mean
+            result = TimerResult(script, samples, runs, timeScale, confidence)
+            result.converged = converged
+
+        if memory:
+            result.memory = self.profile_memory(script, setup, runs)
+        return result
+
+    def profile_memory(self, script, setup='', runs=1000):
+        """
+        Runs script and returns a dict describing its memory behaviour (python 3 only):
+
+            :peak_bytes: gross. The most memory allocated by a single run at
+                any one time, including temporaries which are freed again (tracemalloc)
+            :allocations: gross. [(file:line, bytes, blocks), ...] for the lines
+                of a single run which allocated the most and hadn't freed it at the end.
+            :net_bytes_per_run: bytes allocated and not freed again, averaged over runs runs (tracemalloc)
+            :net_objects_per_run: objects created and not freed again, averaged
+                over runs runs. Only objects tracked by the garbage collector count.
+            :collections: the number of garbage collections during runs runs with the GC enabled
+            :gc_time, gc_max: total and longest duration of those collections in seconds
+
+        Garbage collections pause everything and are a common cause of
+        dropped frames. They are triggered by creating objects, so a script
+        with many net_objects_per_run will cause collections in the experiment.
+        """
+        import gc
+        import timeit
+        import tracemalloc
+
+        # Garbage collections with the GC enabled, like in the experiment. timeit disables it by default.
+        if callable(script) or isinstance(script, _CallTimer):
+            call = script if isinstance(script, _CallTimer) else _CallTimer(script)
+            gc_timer = _CallTimer(call.func, call.args, call.kwargs, keep_gc=True)
+        elif isinstance(setup, dict):
+            gc_timer = timeit.Timer(script, setup='import gc; gc.enable()', globals=setup)
+        else:
+            gc_timer = timeit.Timer(script, setup='import gc; gc.enable()' + ('; from __main__ import ' + setup if setup else ''))
+
+        durations, started = [], [0.0]
+
+        def callback(phase, info):
+            if phase == 'start':
+                started[0] = _clock()
+            else:
+                durations.append(_clock() - started[0])
+        gc.collect()  # start from a clean slate
+        gc.callbacks.append(callback)
+        try:
+            gc_timer.timeit(number=runs)
+        finally:
+            gc.callbacks.remove(callback)
+
+        # Allocations with the GC disabled (by timeit), so nothing is collected in the meantime
+        timer = self._timer(script, setup)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            timer.timeit(number=1)  # the first run may fill caches which later runs reuse
+            peak = 0
+            for i in range(min(runs, 10)):
+                tracemalloc.clear_traces()  # also resets the peak
+                timer.timeit(number=1)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+
+            ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, timeit.__file__)]
+            snapshot = tracemalloc.take_snapshot()
+            timer.timeit(number=1)
+            lines = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(snapshot.filter_traces(ignore), 'lineno')
+            allocations = [('%s:%i' % (line.traceback[0].filename, line.traceback[0].lineno), line.size_diff, line.count_diff)
+                           for line in lines[:5] if line.size_diff > 0]
+
+            before = tracemalloc.get_traced_memory()[0]
+            objects = gc.get_count()[0]
+            timer.timeit(number=runs)
+            objects = gc.get_count()[0] - objects
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        gc.collect()
+
+        return {
+            'peak_bytes': peak,
+            'allocations': allocations,
+            'net_bytes_per_run': (after - before) / float(runs),
+            'net_objects_per_run': objects / float(runs),
+            'collections': len(durations),
+            'gc_time': sum(durations),
+            'gc_max': max(durations) if durations else 0.0
+        }
+
+    def measure_call(self, func, args=(), kwargs=None, **options):
+        """
+        Times calls of func(*args, **kwargs) and returns a TimerResult.
+        The calls run in a tight loop without name lookups and the duration
+        of the empty loop is subtracted. options are passed to measure(),
+        e.g. repeat or precision.
+        """
+        return self.measure(_CallTimer(func, args, kwargs), **options)
+
+    def compare(self, scripts, setup='', rounds=30, confidence=0.95):
+        """
+        Times scripts in interleaved batches and returns a CompareResult.
+        Each round runs one batch of every script in random order, so drift
+        in CPU frequency and temperature affects all scripts equally.
+
+        :scripts: (list) strings to be timed. All are compared to the first.
+        :setup: like in measure(). Shared by all scripts.
+        :rounds: the number of batches of each script.
+        :confidence: the level of the confidence intervals.
+        """
+        import random
+        self.warm_up()
+        baselines = [self.baseline(setup, isinstance(script, _CallTimer) or callable(script)) for script in scripts]
+        timers = [self._timer(script, setup) for script in scripts]
+        runs = [self.calibrate(script, setup) for script in scripts]  # about 20 ms per batch
+
+        samples = [[] for script in scripts]
+        for i in range(rounds):
+            for index in random.sample(range(len(scripts)), len(scripts)):
+                samples[index].append(timers[index].timeit(number=runs[index]) / runs[index] - baselines[index])
+        return CompareResult(scripts, samples, runs, confidence)
+
+
+class TimerResult(object):
+    """
+    The distribution of durations of a code snippet as returned by
+    ppc.measure(). Durations are in seconds:
+
+        :samples: the per-run duration of each batch, sorted
+        :runs: the number of runs in each batch
+        :mean, sd, min, median, p95, p99, max: statistics of the samples
+        :ci: (lower, upper) confidence interval of the mean
+        :timeScale and unit: used when printing the result
+        :converged: whether the requested precision was reached (None if no precision was requested)
+        :memory: allocations and garbage collections if measured with memory=True (see Benchmark.profile_memory)
+
+    Use it to check that something fits your frame budget::
+
+        result = ppc.measure('stim.text = "hi"', 'stim', runs=1, repeat=200)
+        assert result.p99 < 0.1 * 0.01667  # less than a tenth of a 60 Hz frame
+    """
+    def __init__(self, script, samples, runs, timeScale=False, confidence=0.95):
+        self.script = script if isinstance(script, str) else str(_CallTimer(script) if callable(script) else script)
+        self.samples = sorted(samples)
+        self.runs = runs
+        self.confidence = confidence
+        self.mean, self.sd = _mean_sd(self.samples)
+        self.min, self.max = (self.samples[0], self.samples[-1]) if self.samples else (float('nan'), float('nan'))
+        self.median = _percentile(self.samples, 50)
+        self.p95 = _percentile(self.samples, 95)
+        self.p99 = _percentile(self.samples, 99)
+        if len(self.samples) > 1:
+            margin = _t_ppf(0.5 + confidence / 2, len(self.samples) - 1) * self.sd / len(self.samples) ** 0.5
+            self.ci = (self.mean - margin, self.mean + margin)
+        else:
+            self.ci = (float('nan'), float('nan'))
+        self.timeScale = timeScale or _time_scale(self.median)
+        self.unit = _unit(self.timeScale)
+        self.converged = None
+        self.memory = None
+
+    def __repr__(self):
+        scale, unit = self.timeScale, self.unit
+        return '\n'.join([
+            "'%s'" % self.script,
+            'MEAN:   %.3f %s (%i%% CI %.3f to %.3f, SD %.3f) from %i x %i runs' % (self.mean / scale, unit, round(self.confidence * 100), self.ci[0] / scale, self.ci[1] / scale, self.sd / scale, len(self.samples), self.runs),
+            'MEDIAN: %.3f %s, P95: %.3f %s, P99: %.3f %s' % (self.median / scale, unit, self.p95 / scale, unit, self.p99 / scale, unit),
+            'RANGE:  %.3f to %.3f %s' % (self.min / scale, self.max / scale, unit)
+        ] + ([
+            'MEMORY: %i bytes peak per run. Net (not freed again): %.1f bytes and %.2f objects per run' % (self.memory['peak_bytes'], self.memory['net_bytes_per_run'], self.memory['net_objects_per_run']),
+            'GC:     %i collections in %i runs, %.3f ms in total, %.3f ms at most' % (self.memory['collections'], self.runs, self.memory['gc_time'] * 1000, self.memory['gc_max'] * 1000)
+        ] if self.memory else []))
+
+
+class CompareResult(object):
+    """
+    Interleaved timings of scripts as returned by ppc.compare(). Has:
+
+        :results: a TimerResult for each script
+        :ratios: for each script, the ratio of its mean duration to the mean of the first script
+        :cis: for each script, (lower, upper) confidence interval of the ratio
+        :p: for each script, the p-value of a paired t-test of the log-ratio of durations against 0
+
+    Ratios are computed from the pairs of batches run in the same round.
+    They are NaN if a script is too fast to be distinguished from an empty script.
+    """
+    def __init__(self, scripts, samples, runs, confidence=0.95):
+        self.results = [TimerResult(script, sample, run, confidence=confidence) for script, sample, run in zip(scripts, samples, runs)]
+        self.confidence = confidence
+        self.ratios, self.cis, self.p = [], [], []
+        nan = float('nan')
+        for sample in samples:
+            pairs = list(zip(samples[0], sample))
+            if len(pairs) < 2 or any(a <= 0 or b <= 0 for a, b in pairs):
+                self.ratios.append(nan)
+                self.cis.append((nan, nan))
+                self.p.append(nan)
+                continue
+            logs = [math.log(b / a) for a, b in pairs]
+            mean, sd = _mean_sd(logs)
+            error = sd / len(logs) ** 0.5
+            margin = _t_ppf(0.5 + confidence / 2, len(logs) - 1) * error
+            self.ratios.append(math.exp(mean))
+            self.cis.append((math.exp(mean - margin), math.exp(mean + margin)))
+            self.p.append(2 * (1 - _t_cdf(abs(mean / error), len(logs) - 1)) if error > 0 else (0.0 if mean else 1.0))
+
+    def __repr__(self):
+        first = self.results[0]
+        lines = []
+        for result, ratio, ci, p in zip(self.results, self.ratios, self.cis, self.p):
+            lines.append("'%s': median %.3f %s" % (result.script, result.median / first.timeScale, first.unit))
+            if result is not first:
+                lines.append('    %.3f x the first (%i%% CI %.3f to %.3f, p = %.2g)' % (ratio, round(self.confidence * 100), ci[0], ci[1], p))
+        return '\n'.join(lines)
+
+
+_benchmark = None  # the session shared by timer() and friends. Created on first use.
+
+
+def _default_benchmark():
+    global _benchmark
+    if _benchmark is None:
+        _benchmark = Benchmark()
+    return _benchmark
+
+
+def timer(script, setup='', timeScale=False, runs=False):
+    """
+    Times code snippets and returns average duration in seconds.
+    The first call warms up the computer. Later calls reuse the warm-up and
+    the baseline for the same setup, so timing many snippets is fast.
+
+    :script: a string to be timed. Or a function to be called without arguments.
+    :setup: a comma-separated string specifying methods and variables to be imported from __main__
+    :timeScale: the unit for seconds. 10**-9 = nanoseconds. If False, the scale is automagically determined as s, ms, us or ns
+    :runs: how many times to run the script. If False, the number of runs is automagically determine from 3 testruns, trying to keep the total test duration around a second but at least 10 runs and at most 10**6 runs.
+    """
+    return _default_benchmark().timer(script, setup, timeScale, runs)
+
+
+def measure(script, setup='', runs=False, repeat=20, timeScale=False, confidence=0.95, precision=None, budget=10, memory=False):
+    """
+    Times code snippets in repeated batches and returns a TimerResult with
+    min, median, p95, p99, max, SD and a confidence interval of the mean.
+    Print it to see a summary. See Benchmark.measure() for the arguments.
+
+    Use precision to sample until the mean is known precisely enough::
+
+        result = ppc.measure('stim.text = "hi"', 'stim', repeat=5, precision=0.02, budget=5)
+
+    Use memory=True to also see how much the script allocates and whether
+    it triggers garbage collections, which can cause dropped frames::
+
+        print(ppc.measure('stim.text = "hi"', 'stim', memory=True))
+    """
+    return _default_benchmark().measure(script, setup, runs, repeat, timeScale, confidence, precision, budget, memory)
+
+
+_benchmarks = collections.OrderedDict()  # name --> (script, setup function, repeat)
+
+
+def measure_call(func, args=(), kwargs=None, **options):
+    """
+    Times calls of func(*args, **kwargs) and returns a TimerResult. Unlike
+    measure() with a string, this works with closures and methods of objects
+    which are not in __main__, and nothing is compiled. options are passed
+    to Benchmark.measure(), e.g. repeat or precision. Use like::
+
+        print(ppc.measure_call(stim.setPos, ([1, 1],), repeat=50))
+    """
+    return _default_benchmark().measure_call(func, args, kwargs, **options)
+
+
+def timed(func):
+    """
+    Decorator which times every call of a function where it's used, e.g.
+    in run_condition(). func.result() returns a TimerResult of the calls so
+    far and func.reset() clears them. Costs well below a microsecond per call. Use like::
+
+        @ppc.timed
+        def draw_mask():
+            ...
+
+        # after the block:
+        print(draw_mask.result())
+    """
+    import functools
+    durations = []
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = _clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            durations.append(_clock() - start)
+
+    def reset():
+        del durations[:]
+
+    wrapper.result = lambda: TimerResult(func.__name__ + '()', durations, 1)
+    wrapper.reset = reset
+    return wrapper
+
+
+def compare(*scripts, **kwargs):
+    """
+    Times scripts in interleaved batches in random order and returns a
+    CompareResult with the ratio of each script's duration to the first
+    script, with a confidence interval and a p-value. Print it to see a
+    summary. Keyword arguments (setup, rounds, confidence) are passed to
+    Benchmark.compare(). Use like::
+
+        print(ppc.compare('stim.pos = (1, 1)', 'stim.setPos((1, 1))', setup='stim'))
+    """
+    return _default_benchmark().compare(scripts, **kwargs)
+
+
+def register_benchmark(name, script, setup=None, repeat=10):
+    """
+    Adds a code snippet to the benchmarks run by run_benchmarks() and
+    "python -m ppc bench".
+
+    :name: (str) unique name of the benchmark.
+    :script: (str) the code to be timed.
+    :setup: a function returning a dict of the variables used in script.
+        It's called once, right before the benchmark is run.
+    :repeat: (int) the minimum number of batches. More are added until the
+        mean is known within 2% or 5 seconds have passed.
+
+    Use like::
+
+        ppc.register_benchmark('text', 'stim.text = "hi"', lambda: {'stim': visual.TextStim(win)})
+    """
+    _benchmarks[name] = (script, setup, repeat)
+
+
+def _setup_csv_writer(**kwargs):
+    """A csv_writer in a temporary folder which is deleted when python exits"""
+    import atexit
+    import shutil
+    import tempfile
+    folder = tempfile.mkdtemp()
+    writer = csv_writer('benchmark', folder=folder, **kwargs)
+    atexit.register(shutil.rmtree, folder, True)
+    atexit.register(writer.close)  # registered last so it runs first
+    trial = {'no': 1, 'condition': 'trueFix', 'ori': 90, 'xpos': -3, 'duration': 6, 'durationReal': 0.1001, 'response': 'left', 'rt': 0.5312, 'score': 1}
+    return {'writer': writer, 'trial': trial}
+
+
+def _setup_trial_list():
+    import random
+    return {'random': random, 'ORIS': [0, 90], 'POSITIONS': [-3, 0, 3], 'FRAMES': [6, 9, 12], 'REPETITIONS': 20}
+
+
+def _setup_frame_rate():
+    import numpy  # raises ImportError so the benchmark is skipped without numpy
+    return {'getActualFrameRate': getActualFrameRate, 'SimulatedVSync': SimulatedVSync}
+
+
+register_benchmark('deg2cm', 'deg2cm(5, 60)', lambda: {'deg2cm': deg2cm})
+
+
+def _setup_conversions():
+    """10000 angles, e.g. the vertices of a stimulus, and their sizes in pixels. Correctness is tested in test_ppc.py."""
+    import numpy as np
+    angles = np.linspace(-30, 30, 10000)
+    return {'deg2pix': deg2pix, 'pix2deg': pix2deg, 'angles': angles, 'pixels': deg2pix(angles, 60, 50, 1024)}
+
+
+register_benchmark('deg2pix', 'deg2pix(5, 60, 50, 1024)', lambda: {'deg2pix': deg2pix})
+register_benchmark('deg2pix 10000 angles', 'deg2pix(angles, 60, 50, 1024)', _setup_conversions)
+register_benchmark('Geometry.deg2pix 10000 angles', 'geometry.deg2pix(angles)', lambda: dict(_setup_conversions(), geometry=Geometry(60, 50, [1024, 768])))
+
+
+def _setup_dkl():
+    """A palette of 10000 isoluminant colors"""
+    import numpy as np
+    dkl = np.column_stack([np.zeros(10000), np.linspace(0, 360, 10000), np.full(10000, 0.5)])
+    return {'dkl2rgb': dkl2rgb, 'rgb2dkl': rgb2dkl, 'dkl': dkl, 'rgb': dkl2rgb(dkl)}
+
+
+register_benchmark('dkl2rgb one color', 'dkl2rgb([0, 45, 1])', lambda: {'dkl2rgb': dkl2rgb})
+register_benchmark('dkl2rgb 10000 colors', 'dkl2rgb(dkl)', _setup_dkl)
+register_benchmark('dkl2rgb 10000 colors gamma', 'dkl2rgb(dkl, gamma=2.2)', _setup_dkl)
+register_benchmark('rgb2dkl 10000 colors', 'rgb2dkl(rgb)', _setup_dkl)
+
+
+def _setup_color_cache():
+    """A ColorCache with the palette saved in a temporary folder which is deleted when python exits"""
+    import atexit
+    import shutil
+    import tempfile
+    folder = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, folder, True)
+    variables = _setup_dkl()
+    colors = ColorCache(folder=folder, gamma=2.2)
+    colors.dkl2rgb(variables['dkl'])  # computed and saved
+    variables.update(ColorCache=ColorCache, folder=folder, colors=colors)
+    return variables
+
+
+register_benchmark('ColorCache startup 10000 colors', 'ColorCache(folder=folder, gamma=2.2).dkl2rgb(dkl)', _setup_color_cache)
+register_benchmark('ColorCache one color', 'colors.dkl2rgb([0, 45, 0.5])', _setup_color_cache)
+register_benchmark('Sound.beep', 'sound.beep(1000, 0.1)', lambda: {'sound': Sound(backend='null')})
+register_benchmark('pix2deg 10000 pixels', 'pix2deg(pixels, 60, 50, 1024)', _setup_conversions)
+register_benchmark('deg2pix 10000 angles in a loop', '[deg2pix(angle, 60, 50, 1024) for angle in angles]', lambda: {'deg2pix': deg2pix, 'angles': [x / 333.3 - 15 for x in range(10000)]})
+register_benchmark('csv_writer.write', 'writer.write(trial)', _setup_csv_writer)
+register_benchmark('csv_writer.write threaded', 'writer.write(trial)', lambda: _setup_csv_writer(threaded=True, queue_size=10**6))
+register_benchmark('span', 'with recorder: pass', lambda: {'recorder': _Span('benchmark', 1000)})
+register_benchmark('getActualFrameRate', 'getActualFrameRate(1000, SimulatedVSync(drop=0.01, seed=1), verbose=False)', _setup_frame_rate)
+register_benchmark('trial list', """
+trial_list = [{'ori': ori, 'xpos': pos, 'duration': dur, 'response': '', 'rt': ''}
+              for ori in ORIS for pos in POSITIONS for dur in FRAMES for rep in range(REPETITIONS)]
+random.shuffle(trial_list)
+for i, trial in enumerate(trial_list):
+    trial['no'] = i + 1
+""", _setup_trial_list)
+
+
+def run_benchmarks(names=None, baseline_file=None, save=False, threshold=0.1, min_sessions=3, max_sessions=10):
+    """
+    Runs registered benchmarks and compares them to a saved baseline for
+    this machine and python version. Prints a line per benchmark. Returns
+    a dict of TimerResults and a list of names of benchmarks which got slower.
+
+    Timings vary more between runs (other programs, CPU frequency, memory
+    layout) than within a run, so the baseline is the median of each of
+    the last max_sessions saved runs. A benchmark is only called slower
+    when its median is further above the median of those than they varied
+    among themselves (twice their range) and more than threshold.
+
+    :names: (list) names of benchmarks to run. Default: all. A name also
+        selects all benchmarks starting with it, e.g. 'csv_writer'.
+    :baseline_file: (str) JSON file with saved results. Default: ppc_benchmarks.json
+    :save: (bool) add the results to the baseline. Results are also added
+        while there are less than min_sessions runs in the baseline.
+    :threshold: the minimum relative slowdown to count as a regression.
+    :min_sessions: (int) the number of saved runs needed before regressions are judged.
+    :max_sessions: (int) the number of most recent saved runs to keep.
+    """
+    import json
+    import os
+    import platform
+    import time
+
+    baseline_file = baseline_file or 'ppc_benchmarks.json'
+    machine = '%s / %s / Python %s' % (platform.node(), platform.machine(), platform.python_version())
+    saved = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            saved = json.load(f)
+    baseline = saved.get(machine, {})
+
+    bench = Benchmark()
+    results, regressions, changed = collections.OrderedDict(), [], False
+    for name, (script, setup, repeat) in _benchmarks.items():
+        if names and not any(name.startswith(selected) for selected in names):
+            continue
+        try:
+            variables = setup() if setup else {}
+        except ImportError as error:  # e.g. numpy not installed
+            print('%-30s skipped: %s' % (name, error))
+            continue
+        result = bench.measure(script, variables, repeat=repeat, precision=0.02, budget=5)
+        result.script = name
+        results[name] = result
+
+        # Compare to the median of the saved runs
+        line = '%-30s %10.3f %s' % (name, result.median / result.timeScale, result.unit)
+        medians = baseline.get(name, {}).get('medians', [])
+        if medians:
+            change = result.median / _percentile(sorted(medians), 50) - 1
+            line += '  %+6.1f%% vs baseline' % (change * 100)
+            if len(medians) < min_sessions:
+                line += ' (%i of %i runs saved, not judged)' % (len(medians), min_sessions)
+            else:
+                limit = max(threshold, 2 * (max(medians) / min(medians) - 1))
+                line += ' (limit %+.0f%%)' % (limit * 100)
+                if change > limit:
+                    regressions.append(name)
+                    line += '  SLOWER'
+        print(line)
+
+        # Add this run to the baseline
+        if save or len(medians) < min_sessions:
+            baseline[name] = {'medians': (medians + [result.median])[-max_sessions:], 'runs': result.runs, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+            changed = True
+
+    if changed:
+        saved[machine] = baseline
+        with open(baseline_file, 'w') as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+        print('added this run to the baseline for', machine, 'in', baseline_file)
+
+    return results, regressions
+
+
+_gc_pending = False  # whether a critical period has left garbage collection for collect_idle()
+_gc_frozen = False  # whether collect_idle(freeze=True) has frozen the objects from setup
+
+
+class critical(object):
+    """
+    Context manager for timing critical periods like the frames of a trial.
+    The garbage collector is disabled inside so a collection can't pause
+    your flip-loop. The collection happens when you call collect_idle(),
+    e.g. while waiting for a response. Use like::
+
+        with ppc.critical(win):
+            for frame in range(FRAMES_STIM):
+                stim.draw()
+                win.flip()
+
+        ppc.collect_idle()  # somewhere non-critical, e.g. in ask()
+        ppc.critical.report()  # at the end, see the effect
+
+    The garbage collector is turned back on (if it was on) when the period
+    ends, so if collect_idle() is not called, garbage is collected whenever
+    python decides to, as usual.
+
+    :win: (psychopy Window) optional. Records the frame intervals inside
+        and logs the longest one in critical.log for report().
+    :enabled: (bool) set to False to do the same logging without touching
+        the garbage collector, e.g. on every other trial to compare.
+
+    After the period, these are available:
+        :objects: net number of objects created inside (which the GC tracks)
+        :worst_interval: the longest frame interval in seconds (if win was given)
+    """
+    log = {True: [], False: []}  # the worst frame interval of each period, with and without the GC disabled
+
+    def __init__(self, win=None, enabled=True):
+        self.win = win
+        self.enabled = enabled
+        self.objects = None
+        self.worst_interval = None
+
+    def __enter__(self):
+        import gc
+        self._gc_was_enabled = gc.isenabled()
+        if self.enabled:
+            gc.disable()
+        if self.win is not None:
+            self._recorded = self.win.recordFrameIntervals
+            self.win.recordFrameIntervals = True
+            self._first_interval = len(self.win.frameIntervals)
+        self._objects = gc.get_count()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        global _gc_pending
+        import gc
+        self.objects = gc.get_count()[0] - self._objects  # only exact when no collection ran, i.e. when enabled
+        if self.enabled:
+            _gc_pending = True
+            if self._gc_was_enabled:
+                gc.enable()
+        if self.win is not None:
+            self.win.recordFrameIntervals = self._recorded
+            # The first interval started before this period. psychopy already skips it when recording was just turned on.
+            intervals = self.win.frameIntervals[self._first_interval + (1 if self._recorded else 0):]
+            if intervals:
+                self.worst_interval = max(intervals)
+                critical.log[self.enabled].append(self.worst_interval)
+        return False
+
+    @classmethod
+    def report(cls):
+        """Prints and returns the worst frame interval with and without the garbage collector disabled."""
+        summary = {}
+        for enabled, name in [(True, 'with'), (False, 'without')]:
+            intervals = sorted(cls.log[enabled])
+            summary[name] = {'periods': len(intervals), 'worst': intervals[-1] if intervals else float('nan'), 'p95': _percentile(intervals, 95)}
+            print('%s ppc.critical: worst frame interval %.3f ms (95th percentile of periods %.3f ms) in %i periods' % (
+                name, summary[name]['worst'] * 1000, summary[name]['p95'] * 1000, len(intervals)))
+        return summary
+
+
+def collect_idle(freeze=False):
+    """
+    Does the garbage collection postponed by critical periods. Call it where
+    a pause of some milliseconds doesn't matter, e.g. while waiting for a
+    keypress. Returns the duration in seconds.
+
+    :freeze: (bool) after collecting, move all surviving objects to a
+        permanent generation which is never scanned again (python 3.7+), so
+        later collections are faster. Do this once after setting up stimuli
+        etc. Objects which are alive at that moment are never collected, so
+        it only happens the first time freeze=True is used.
+    """
+    global _gc_pending, _gc_frozen
+    import gc
+    if not _gc_pending and not (freeze and not _gc_frozen):
+        return 0.0
+    start = _clock()
+    gc.collect()
+    if freeze and not _gc_frozen and hasattr(gc, 'freeze'):
+        gc.freeze()
+        _gc_frozen = True
+    _gc_pending = False
+    return _clock() - start
+
+
+class _Span(object):
+    """
+    Records durations of one labeled span in a preallocated ring buffer of
+    nanoseconds (integers on python 3, floats on python 2 which has no 64 bit
+    integer arrays). Used as a context manager and as a decorator. Not
+    re-entrant: don't nest spans with the same label.
+    """
+    __slots__ = ('label', 'durations', 'count', '_start', '_index', '_size')
+
+    def __init__(self, label, size):
+        import array
+        self.label = label
+        self.durations = array.array('q' if python3 else 'd', [0]) * size
+        self.count = 0
+        self._start = 0
+        self._index = 0  # where the next duration goes
+        self._size = size
+
+    def __enter__(self):
+        self._start = _clock_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        index = self._index
+        self.durations[index] = _clock_ns() - self._start
+        self._index = index + 1 if index + 1 < self._size else 0
+        self.count += 1
+        return False
+
+    def __call__(self, func):
+        """Use the span as a decorator"""
+        import functools
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+    def values(self):
+        """Returns the recorded durations in seconds, oldest first."""
+        if self.count <= self._size:
+            recorded = self.durations[:self.count]
+        else:
+            recorded = self.durations[self._index:] + self.durations[:self._index]
+        return [duration / 1e9 for duration in recorded]
+
+    def histogram(self, edges=(10**-6, 10**-5, 10**-4, 10**-3, 10**-2, 10**-1)):
+        """Returns the number of durations below each edge (in seconds) and above the last, i.e. len(edges) + 1 counts."""
+        import bisect
+        counts = [0] * (len(edges) + 1)
+        for duration in self.values():
+            counts[bisect.bisect_right(edges, duration)] += 1
+        return counts
+
+
+_spans = {}  # label --> _Span
+
+
+def span(label, size=10000):
+    """
+    Times a labeled part of your code with very little overhead (well below
+    a microsecond). Durations go into a preallocated buffer per label, which
+    keeps the last size durations. Nothing is computed until span_report().
+    Use as a context manager or as a decorator::
+
+        for frame in range(FRAMES_MASK):
+            with ppc.span('mask_draw'):
+                stim_mask.draw()
+            win.flip()
+
+        @ppc.span('prepare')
+        def prepare_trial(trial):
+            ...
+
+        ppc.span_report()  # after the trial, block or experiment
+
+    In the tightest loops, get the span once and reuse it::
+
+        mask_span = ppc.span('mask_draw')
+        for frame in range(FRAMES_MASK):
+            with mask_span:
+                stim_mask.draw()
+    """
+    try:
+        return _spans[label]
+    except KeyError:
+        _spans[label] = _Span(label, size)
+        return _spans[label]
+
+
+def span_report(reset=False):
+    """
+    Prints a summary of all spans and returns it as a dict with label -->
+    {'count', 'mean', 'median', 'p95', 'p99', 'max', 'histogram'} in seconds.
+    The histogram counts durations below 1 us, 10 us, 100 us, 1 ms, 10 ms, 100 ms and above.
+
+    :reset: (bool) clear the spans afterwards, e.g. to report per trial.
+    """
+    summary = collections.OrderedDict()
+    for label in sorted(_spans):
+        durations = sorted(_spans[label].values())
+        if not durations:
+            continue
+        summary[label] = {
+            'count': _spans[label].count,
+            'mean': _mean_sd(durations)[0],
+            'median': _percentile(durations, 50),
+            'p95': _percentile(durations, 95),
+            'p99': _percentile(durations, 99),
+            'max': durations[-1],
+            'histogram': _spans[label].histogram()
+        }
+        print('%-20s n=%-7i median %9.3f us  p95 %9.3f us  p99 %9.3f us  max %9.3f us' % (
+            label, summary[label]['count'], summary[label]['median'] * 10**6, summary[label]['p95'] * 10**6, summary[label]['p99'] * 10**6, summary[label]['max'] * 10**6))
+    if reset:
+        span_reset()
+    return summary
+
+
+def span_reset():
+    """Clears all spans."""
+    for recorder in _spans.values():
+        recorder.count = 0
+        recorder._index = 0
+
+
+class Sampler(object):
+    """
+    A sampling profiler which tells you what the main thread was doing when
+    frames took too long. A background thread takes a snapshot of the main
+    thread's stack every interval seconds, tagged with the current frame
+    number. Call tick() after every flip. report() then shows the most common
+    stacks during the overlong frames. Use like::
+
+        sampler = ppc.Sampler()
+        sampler.start()
+        for frame in range(FRAMES):
+            stim.draw()
+            win.flip()
+            sampler.tick()
+        sampler.stop()
+        sampler.report()
+
+    Python only switches threads every sys.getswitchinterval() seconds, so
+    this is lowered to interval while sampling. On python 2, the check
+    interval is lowered to 10 bytecode instructions instead. Sampling takes a bit of CPU
+    time from the main thread, so use it to find problems, not while
+    collecting data.
+
+    :interval: (float) seconds between samples.
+    :depth: (int) the maximum number of stack frames to record per sample.
+    :thread_id: the thread to sample. Defaults to the thread which creates the Sampler.
+    """
+    def __init__(self, interval=0.001, depth=30, thread_id=None):
+        import threading
+        self.interval = interval
+        self.depth = depth
+        self.thread_id = thread_id if thread_id is not None else threading.current_thread().ident
+        self.frame = 0  # number of ticks so far. Samples are tagged with it.
+        self.ticks = []  # time of each tick
+        self.samples = []  # (frame, stack) where stack is a tuple of (filename, line, function), innermost first
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts sampling."""
+        import threading
+        if hasattr(sys, 'getswitchinterval'):
+            self._switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(min(self._switch_interval, self.interval))
+        else:  # python 2 switches threads every so many bytecode instructions
+            self._switch_interval = sys.getcheckinterval()
+            sys.setcheckinterval(min(self._switch_interval, 10))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ppc sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            if hasattr(sys, 'setswitchinterval'):
+                sys.setswitchinterval(self._switch_interval)
+            else:
+                sys.setcheckinterval(self._switch_interval)
+
+    def tick(self):
+        """Call after each flip. Marks the start of a new frame."""
+        self.ticks.append(_clock())
+        self.frame += 1
+
+    def _run(self):
+        """The sampler thread"""
+        current_frames, append, thread_id, depth = sys._current_frames, self.samples.append, self.thread_id, self.depth
+        while not self._stop.wait(self.interval):
+            frame = current_frames().get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < depth:
+                code = frame.f_code
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            append((self.frame, tuple(stack)))
+
+    def overlong(self, threshold=1.5):
+        """Returns the numbers of the frames which lasted more than threshold times the median frame interval."""
+        intervals = [self.ticks[i] - self.ticks[i - 1] for i in range(1, len(self.ticks))]
+        if not intervals:
+            return set()
+        limit = threshold * _percentile(sorted(intervals), 50)
+        return set(i + 1 for i, interval in enumerate(intervals) if interval > limit)  # interval i ends with tick i + 1
+
+    def report(self, threshold=1.5, top=5):
+        """
+        Prints the most common stacks during frames lasting more than threshold
+        times the median frame interval. Returns a list of (stack, count).
+        """
+        import os
+        slow = self.overlong(threshold)
+        stacks = collections.Counter(stack for frame, stack in self.samples if frame in slow)
+        print('%i of %i frames were more than %.1f times the median duration. %i of %i samples were taken during those.' % (
+            len(slow), max(len(self.ticks) - 1, 0), threshold, sum(stacks.values()), len(self.samples)))
+        for stack, count in stacks.most_common(top):
+            print('\n%i samples:' % count)
+            for filename, line, function in stack:
+                print('    %s:%i in %s' % (os.path.basename(filename), line, function))
+        return stacks.most_common()
+
+
+class Scheduler(object):
+    """
+    Waits for deadlines with microsecond precision without burning a whole
+    CPU core. It sleeps until margin seconds before the deadline and busy-waits
+    for the rest. Deadlines are absolute: the n'th tick is due at
+    start + n * interval, so small delays don't add up as they do when you
+    reset a clock every frame. Use like::
+
+        scheduler = ppc.Scheduler(ppc.frame_interval(win))
+        scheduler.start()
+        for frame in range(60):
+            stim.draw()
+            scheduler.tick()  # wait for the next imaginary flip
+            win.flip()
+        scheduler.report()
+
+    The lateness of each tick (seconds after its deadline) is kept in a
+    preallocated buffer of the last size ticks.
+
+    :interval: (float) seconds between ticks.
+    :margin: (float) seconds to busy-wait before each deadline. If None,
+        calibrate() measures how late time.sleep() wakes up on this computer.
+        The margin then follows the 95th percentile of how late sleep woke
+        up in the last 100 waits. It grows at once when sleep wakes up after
+        a deadline and shrinks again if that was a one-off.
+    :max_margin: (float) the margin never gets larger than this, so a few
+        long hiccups of the OS can't turn it into a busy-wait of the whole
+        interval. Default: half the interval, or 5 ms without an interval.
+    :size: (int) the number of latenesses to keep.
+    """
+    def __init__(self, interval=None, margin=None, size=10000, max_margin=None):
+        import array
+        self.interval = interval
+        self.max_margin = max_margin if max_margin is not None else (interval / 2.0 if interval else 0.005)
+        self.margin = min(margin if margin is not None else self.calibrate(), self.max_margin)
+        self._overshoots = collections.deque(maxlen=100)  # how late recent sleeps woke up
+        self.lateness = array.array('d', [0.0]) * size
+        self.count = 0  # number of deadlines waited for
+        self.missed = 0  # number of ticks skipped because we were more than an interval late
+        self.deadline = None  # the last deadline
+        self._tick = None  # the time of the last tick
+        self._size = size
+
+    @staticmethod
+    def calibrate(samples=50, duration=0.001):
+        """Returns a margin: the 99th percentile of how late time.sleep(duration) wakes up, plus 0.2 ms."""
+        import time
+        overshoots = []
+        for i in range(samples):
+            start = _clock()
+            time.sleep(duration)
+            overshoots.append(_clock() - start - duration)
+        return max(_percentile(sorted(overshoots), 99), 0) + 0.0002
+
+    def start(self, time=None):
+        """Sets the time of tick 0. Defaults to now. Returns it."""
+        self.deadline = self._tick = _clock() if time is None else time
+        return self._tick
+
+    def wait_until(self, deadline):
+        """Waits until the absolute time deadline (on ppc's clock). Returns the lateness in seconds."""
+        import time
+        remaining = deadline - self.margin - _clock()
+        if remaining > 0:
+            time.sleep(remaining)
+            overshoot = _clock() - deadline + self.margin  # how late sleep woke up
+            self._overshoots.append(overshoot)
+            if overshoot > self.margin:  # woke up after the deadline. Spin for longer next time.
+                self.margin = min(overshoot + 0.0002, self.max_margin)
+            elif self.count % 100 == 99:  # every 100 waits, follow recent overshoots, also down
+                self.margin = min(_percentile(sorted(self._overshoots), 95) + 0.0002, self.max_margin)
+        while _clock() < deadline:
+            pass
+        lateness = _clock() - deadline
+
+        index = self.count % self._size
+        self.lateness[index] = lateness
+        self.count += 1
+        self.deadline = deadline
+        return lateness
+
+    def wait(self, duration):
+        """
+        Waits until duration seconds after the last deadline, e.g. a sound
+        onset relative to a tick. Doesn't move the ticks. Returns the lateness.
+        """
+        if self.deadline is None:
+            self.start()
+        return self.wait_until(self.deadline + duration)
+
+    def tick(self):
+        """
+        Waits until the next tick. If we're already more than one interval
+        late, the missed ticks are skipped (counted in self.missed) rather
+        than returning immediately several times in a row. Returns the lateness.
+        """
+        if not self.interval:
+            raise ValueError('tick() needs an interval, e.g. ppc.Scheduler(0.01667). wait() and wait_until() work without one.')
+        if self._tick is None:
+            self.start()
+        deadline = self._tick + self.interval
+        behind = int((_clock() - deadline) / self.interval)
+        if behind > 0:
+            self.missed += behind
+            deadline += behind * self.interval
+        self._tick = deadline
+        return self.wait_until(deadline)
+
+    def values(self):
+        """Returns the recorded latenesses in seconds, oldest first."""
+        if self.count <= self._size:
+            return list(self.lateness[:self.count])
+        index = self.count % self._size
+        return list(self.lateness[index:] + self.lateness[:index])
+
+    def report(self):
+        """Prints and returns a dict with statistics on lateness in seconds."""
+        values = sorted(self.values())
+        result = {'count': self.count, 'missed': self.missed, 'margin': self.margin}
+        if values:
+            result.update(mean=sum(values) / len(values), p50=_percentile(values, 50), p99=_percentile(values, 99), max=values[-1])
+            print('%i deadlines, %i ticks missed. Lateness: median %.1f us, 99%% %.1f us, max %.1f us. Busy-waiting %.2f ms before each deadline.' % (
+                self.count, self.missed, result['p50'] * 1e6, result['p99'] * 1e6, result['max'] * 1e6, self.margin * 1000))
+        return result
+
+
+# Conversions between visual degrees, cm and pixels. Numbers are computed
+# with math, which is fastest for a single value. Everything else (numpy
+# arrays, lists) is computed with numpy in one go, which is much faster than
+# converting values one at a time.
+_scalar_types = (int, float)
+
+
+def deg2cm(angle, distance, centered=True):
+    """
+    Returns the size of a stimulus in cm given:
+        :distance: ... to monitor in cm
+        :angle: ... that stimulus extends as seen from the eye. A number or
+            an array of numbers, e.g. vertices.
+        :centered: if True, the stimulus is centered on the line of sight:
+            2 * distance * tan(angle / 2). If False, angle is measured from
+            the line of sight, e.g. the eccentricity of a position:
+            distance * tan(angle).
+
+    Use this function to verify whether your stimuli are the expected size.
+    (psychopy.tools.monitorunittools.deg2cm, and thereby psychopy's 'deg'
+    units, is linear: angle * distance * 0.017455. That is 0.2% too small
+    at 10 degrees, 1% at 20 degrees and 4% at 40 degrees.)
+    """
+    if isinstance(angle, _scalar_types):
+        if centered:
+            return 2 * distance * math.tan(math.radians(angle) / 2)
+        return distance * math.tan(math.radians(angle))
+    import numpy as np
+    if centered:
+        return 2 * distance * np.tan(np.radians(angle) / 2)
+    return distance * np.tan(np.radians(angle))
+
+
+def cm2deg(cm, distance, centered=True):
+    """
+    Returns the visual angle in degrees of a stimulus of cm centimeters. The
+    inverse of deg2cm(). See it for arguments.
+    """
+    if isinstance(cm, _scalar_types):
+        if centered:
+            return 2 * math.degrees(math.atan(cm / (2.0 * distance)))
+        return math.degrees(math.atan(cm / float(distance)))
+    import numpy as np
+    if centered:
+        return 2 * np.degrees(np.arctan(np.asarray(cm) / (2.0 * distance)))
+    return np.degrees(np.arctan(np.asarray(cm) / float(distance)))
+
+
+def cm2pix(cm, width, pixels):
+    """
+    Returns the number of pixels in cm centimeters on the monitor.
+        :cm: a number or an array of numbers.
+        :width: the width of the monitor in cm.
+        :pixels: the width of the monitor in pixels.
+    """
+    if not isinstance(cm, _scalar_types):
+        import numpy as np
+        cm = np.asarray(cm)
+    return cm * (pixels / float(width))
+
+
+def pix2cm(pix, width, pixels):
+    """Returns the number of cm of pix pixels. The inverse of cm2pix()."""
+    if not isinstance(pix, _scalar_types):
+        import numpy as np
+        pix = np.asarray(pix)
+    return pix * (width / float(pixels))
+
+
+def deg2pix(angle, distance, width, pixels, centered=True):
+    """
+    Returns the size in pixels of a stimulus extending angle degrees. See
+    deg2cm() and cm2pix() for the arguments. E.g.
+    ppc.deg2pix(GABOR_SIZE, MON_DISTANCE, MON_WIDTH, MON_SIZE[0]).
+    """
+    return cm2pix(deg2cm(angle, distance, centered), width, pixels)
+
+
+def pix2deg(pix, distance, width, pixels, centered=True):
+    """Returns the visual angle in degrees of pix pixels. The inverse of deg2pix()."""
+    return cm2deg(pix2cm(pix, width, pixels), distance, centered)
+
+
+class Geometry(object):
+    """
+    The geometry of the monitor and the participant's eyes. Make it once per
+    session and pass it to stimuli and analysis code. It can't be changed
+    afterwards, so everyone uses the same numbers::
 
-        beep = ppc.Sound('beep.wav')
-        beep.play()
+        GEOMETRY = ppc.Geometry(MON_DISTANCE, MON_WIDTH, MON_SIZE)
+        GEOMETRY.deg2pix(GABOR_SIZE)
+        GEOMETRY.deg2pix(vertices)  # numpy array
 
-        # or generated beep:
-        beep = ppc.Sound()
-        beep.beep(1000, 0.2)  # 1000 Hz for 0.2 seconds
+    Conversion factors are precomputed. Single numbers are converted with
+    math. Arrays of degrees are converted to pixels by linear interpolation
+    in a dense lookup table (error well below 0.001 pixel), which is as fast
+    as numpy's trigonometry and does not depend on the platform's tan().
+    See deg2cm() etc. for the formulas and the meaning of centered.
+
+    :distance: (float) distance between eyes and monitor in cm.
+    :width: (float) width of the monitor in cm.
+    :size: (list) [width, height] of the monitor in pixels.
+    :max_angle: (float) the largest centered angle in the lookup table. Larger
+        angles are computed exactly.
+    :resolution: (float) degrees between entries in the lookup table.
+
+    Attributes:
+        :pix_per_cm: pixels per cm on the monitor.
+        :degrees: numpy array with the angles in the lookup table.
+        :cm_per_deg: numpy array. How much a centered stimulus of each of
+            those sizes grows in cm per extra degree.
+        :deg2pix_lut: numpy array. The size in pixels of each of those angles.
     """
-    def __init__(self, filename=''):
-        """ :filename: a .wav file"""
-        self.sound = filename
-        self._winsound = __import__('winsound')
+    __slots__ = ('distance', 'width', 'size', 'max_angle', 'resolution', 'pix_per_cm', 'degrees', 'cm_per_deg', 'deg2pix_lut', '_lut_slope')
 
-    def play(self):
-        """ plays the sound file with low latency"""
-        self._winsound.PlaySound(self.sound,  self._winsound.SND_FILENAME | self._winsound.SND_ASYNC)
+    def __init__(self, distance, width, size, max_angle=120, resolution=0.01):
+        import numpy as np
+        assign = super(Geometry, self).__setattr__
+        assign('distance', float(distance))
+        assign('width', float(width))
+        assign('size', tuple(int(pixels) for pixels in size))
+        assign('max_angle', float(max_angle))
+        assign('resolution', float(resolution))
+        assign('pix_per_cm', self.size[0] / self.width)
 
-    def beep(self, frequency, duration):
-        """ plays a beep with low latency"""
-        self._winsound.Beep(frequency, duration / float(1000))
+        # Lookup tables. Read-only like the rest.
+        degrees = np.arange(int(round(max_angle / resolution)) + 2) * resolution
+        cm_per_deg = self.distance * np.radians(1) / np.cos(np.radians(degrees) / 2) ** 2  # derivative of 2 * distance * tan(angle / 2)
+        lut = deg2cm(degrees, self.distance) * self.pix_per_cm
+        lut_slope = np.diff(lut)
+        for array in (degrees, cm_per_deg, lut, lut_slope):
+            array.flags.writeable = False
+        assign('degrees', degrees)
+        assign('cm_per_deg', cm_per_deg)
+        assign('deg2pix_lut', lut)
+        assign('_lut_slope', lut_slope)
 
+    @classmethod
+    def from_monitor(cls, monitor, **kwargs):
+        """Makes a Geometry from a psychopy.monitors.Monitor."""
+        return cls(monitor.getDistance(), monitor.getWidth(), monitor.getSizePix(), **kwargs)
 
-def timer(script, setup='', timeScale=False, runs=False):
-    """
-    Times code snippets and returns average duration in seconds.
+    def __setattr__(self, name, value):
+        raise AttributeError('Geometry is immutable. Make a new one instead.')
 
-    :script: a string to be timed
-    :setup: a comma-separated string specifying methods and variables to be imported from __main__
-    :timeScale: the unit for seconds. 10**-9 = nanoseconds. If False, the scale is automagically determined as s, ms, us or ns
-    :runs: how many times to run the script. If False, the number of runs is automagically determine from 3 testruns, trying to keep the total test duration around a second but at least 10 runs and at most 10**6 runs.
-    """
-    if setup:
-        setup = 'from __main__ import ' + setup
+    def __delattr__(self, name):
+        raise AttributeError('Geometry is immutable. Make a new one instead.')
 
-    import timeit
-    timeit.timeit(number=10**7)  # get the computer's attention/ressources. First run is slower.
+    def __reduce__(self):
+        return (Geometry, (self.distance, self.width, self.size, self.max_angle, self.resolution))
 
-    # optional: determine appropriate number of runs from 3 test runs
-    if not runs:
-        result = timeit.timeit(script, setup=setup, number=3)
-        runs = int(3 / result) if result > 0 else 10 ** 6
-        if runs > 10 ** 6:
-            runs = 10 ** 6  # a million at most
-        if runs < 10:
-            runs = 10  # ten at least
+    def __eq__(self, other):
+        return isinstance(other, Geometry) and self.__reduce__() == other.__reduce__()
 
-    # Actually do the timing
-    baseline = timeit.timeit(setup=setup, number=runs)  # the time it takes to run an empty script
-    result = timeit.timeit(script, setup=setup, number=runs)  # Run the test!
-    mean = (result - baseline) / runs  # in seconds
+    def __ne__(self, other):
+        return not self == other
 
-    # Optional: determine appropriate timeScale for reporting
-    if not timeScale:
-        timeScale = 1 if mean > 1 else 10**-3 if mean > 10**-3 else 10**-6 if mean > 10**-6 else 10**-9
-    unit = 's' if timeScale == 1 else 'ms' if timeScale == 10**-3 else 'us' if timeScale == 10**-6 else 'ns' if timeScale == 10**-9 else '*' + str(timeScale)
+    def __hash__(self):
+        return hash(self.__reduce__()[1])
 
-    # Print results
-    print('\n\'', script, '\'')
-    print('AVERAGE:', round(mean / timeScale, 3), unit, 'from', runs, 'runs')
+    def __repr__(self):
+        return 'Geometry(distance=%g, width=%g, size=%s)' % (self.distance, self.width, list(self.size))
 
+    def deg2pix(self, angle, centered=True):
+        """Returns the size in pixels of angle degrees. A number or an array."""
+        if isinstance(angle, _scalar_types):
+            return deg2cm(angle, self.distance, centered) * self.pix_per_cm
+        import numpy as np
+        angle = np.asarray(angle, dtype=float)
+        if not angle.ndim:
+            return self.deg2pix(float(angle), centered)
+        if not centered:  # distance * tan(angle) is half the centered size of twice the angle
+            return self.deg2pix(angle * 2) / 2
 
-def deg2cm(angle, distance):
-    """
-    Returns the size of a stimulus in cm given:
-        :distance: ... to monitor in cm
-        :angle: ... that stimulus extends as seen from the eye
+        # Linear interpolation in the lookup table
+        position = np.abs(angle) * (1 / self.resolution)
+        outside = ~(position < len(self._lut_slope))  # outside the table, NaN or inf. Computed exactly below.
+        exact = outside.any()
+        if exact:
+            position[outside] = 0
+        index = position.astype(np.intp)
+        position -= index
+        result = self._lut_slope.take(index)
+        result *= position
+        result += self.deg2pix_lut.take(index)
+        np.copysign(result, angle, out=result)
+        if exact:
+            result[outside] = deg2cm(angle[outside], self.distance) * self.pix_per_cm
+        return result
 
-    Use this function to verify whether your stimuli are the expected size.
-    (there's an equivalent in psychopy.tools.monitorunittools.deg2cm)
-    """
-    import math
-    return math.tan(math.radians(angle)) * distance  # trigonometry
+    def pix2deg(self, pix, centered=True):
+        """Returns the visual angle in degrees of pix pixels. A number or an array."""
+        return cm2deg(pix2cm(pix, self.width, self.size[0]), self.distance, centered)
+
+    def deg2cm(self, angle, centered=True):
+        """Returns the size in cm of angle degrees. A number or an array."""
+        if isinstance(angle, _scalar_types):
+            return deg2cm(angle, self.distance, centered)
+        return self.deg2pix(angle, centered) / self.pix_per_cm
+
+    def cm2deg(self, cm, centered=True):
+        """Returns the visual angle in degrees of cm centimeters. A number or an array."""
+        return cm2deg(cm, self.distance, centered)
+
+    def cm2pix(self, cm):
+        """Returns the number of pixels in cm centimeters. A number or an array."""
+        return cm2pix(cm, self.width, self.size[0])
+
+    def pix2cm(self, pix):
+        """Returns the number of cm in pix pixels. A number or an array."""
+        return pix2cm(pix, self.width, self.size[0])
 
 
 class csv_writer(object):
-    def __init__(self, filename_prefix='', folder='', column_order=[]):
+    def __init__(self, filename_prefix='', folder='', column_order=[], threaded=False, queue_size=1000, sync_every=0, sync_interval=0, journal=False, journal_group=20, compression=None, block_size=100):
         """
         Take a dictionary and write it to a csv file as a row.
         Writing is very fast - less than a microsecond.
@@ -108,6 +1827,32 @@ class csv_writer(object):
         :filename_prefix: (str) would usually be the id of the participant
         :folder: (str) optionally use/create a folder.
         :column_order: (list) The columns to put first in the csv. Some or all.
+            The remaining columns follow in the order of the first trial.
+            The columns are fixed after the first trial. Columns which only
+            show up in later trials are saved to a separate file with the
+            same name plus " extra columns" in the format row, column, value.
+        :threaded: (bool) if True, write() only puts a copy of the trial in a
+            queue and a background thread does the actual writing. Use this
+            if you write during timing critical periods. writer.stats() tells
+            you how long write() took and how full the queue got.
+        :queue_size: (int) in threaded mode, the maximum number of trials
+            waiting to be written before write() has to wait.
+        :sync_every: (int) force data to disk every this many trials. 0 = never.
+        :sync_interval: (float) force data to disk when this many seconds have
+            passed since the last time. 0 = never. It is checked on write().
+            If both are 0, data is only forced to disk when you call flush(),
+            e.g. while waiting for a response, and when the file is closed.
+        :journal: (bool) also append each trial to a checksummed journal file
+            next to the csv (same name plus ".journal"). If the computer
+            crashes, ppc.recover(writer.save_file) rebuilds the csv from it.
+        :journal_group: (int) force the journal to disk every this many trials.
+        :compression: (str) 'gzip' or 'xz' to save a compressed csv (".csv.gz"
+            or ".csv.xz"). Compression happens on the background thread, so
+            this implies threaded=True. The file consists of independently
+            compressed blocks, so a crash loses at most the current block.
+            stats() reports the compression ratio and CPU time.
+        :block_size: (int) with compression, the maximum number of trials per
+            compressed block. A block also ends whenever data is synced to disk.
 
         Use like:
 
@@ -119,14 +1864,32 @@ class csv_writer(object):
             writer.write(trial)
 
             # Optional: forces save of hitherto collected data to disk.
+            # Do it in a non-critical period, e.g. a break.
             # writer.flush()
+
+            # Optional: in threaded mode, wait for all trials to be written.
+            # This also happens automatically when the script terminates.
+            # writer.close()
         """
 
         import os
         import time
 
         self.column_order = column_order
-        self._header_written = False
+        self.fieldnames = None  # all columns. Set on the first trial.
+        self._encode = None  # function returning a row from a trial. Compiled on first trial.
+        self._rows = 0
+        self._extra_file = None
+        self.compression = compression
+        self.block_size = block_size
+
+        # Durability policy and bookkeeping
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._unsynced = 0  # trials written since last sync
+        self._last_sync = _clock()
+        self.sync_durations = []  # seconds spent in each sync
+        self._fsync = getattr(os, 'fdatasync', os.fsync)  # fdatasync skips metadata. Not on Windows and Mac.
 
         # Create folder if it doesn't exist
         if folder:
@@ -135,91 +1898,1221 @@ class csv_writer(object):
                 os.makedirs(folder)
 
         # Generate self.save_file and self.writer
-        self.save_file = '%s%s (%s).csv' % (folder, filename_prefix, time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()))  # Filename for csv. E.g. "myFolder/subj1_cond2 (2013-12-28 09-53-04).csv"
+        self._name = '%s%s (%s)' % (folder, filename_prefix, time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()))  # E.g. "myFolder/subj1_cond2 (2013-12-28 09-53-04)"
+        self.save_file = self._name + {None: '.csv', 'gzip': '.csv.gz', 'xz': '.csv.xz'}[compression]  # Filename for csv.
         self._setup_file()
 
+        # Optional write-ahead journal. Unbuffered, so each record is a single append to the OS.
+        self._journal = None
+        if journal:
+            self._journal = open(self.save_file + '.journal', 'ab', 0)
+            self._journal_group = journal_group
+            self._journaled = 0  # records since last journal sync
+            self._journal.write(_journal_record(b'H', self.column_order))
+
+        # Optionally hand trials over to a background thread which writes them in batches
+        self._background = None
+        if threaded or compression:
+            import atexit
+            self._background = _BackgroundWriter(self._write_batch, queue_size=queue_size)
+            atexit.register(self.close)
+
     def _setup_file(self):
         """Setting up the self.writer depends on python version."""
         import csv
 
-        if python3:
+        if self.compression:
+            # csv text goes to a memory buffer. _compress() moves it to the file on disk.
+            import io
+            self._file = io.StringIO(newline='') if python3 else io.BytesIO()
+            self._disk = open(self.save_file, 'ab')
+            self._compressor = None
+            self._block = []  # compressed data of the current block. Written when the block is finished.
+            self._block_rows = 0
+            self.compression_stats = {'bytes_in': 0, 'bytes_out': 0, 'cpu': 0.0}
+        elif python3:
             self._file = open(self.save_file, 'a', newline='')
         else:
             self._file = open(self.save_file, 'wb')
 
-        self.writer = csv.DictWriter(self._file, fieldnames=self.column_order)  # The writer function to csv. It appends a single row to file
+        if not self.compression:
+            self._disk = self._file
+        self.writer = csv.writer(self._file)  # The writer function to csv. It appends a single row to file
+
+    def _compress(self, end_block=False):
+        """
+        Compresses the csv text in the memory buffer. Ending a block completes
+        a gzip member / xz stream which can be decompressed on its own, and
+        appends it to the file. Concatenated, they form a valid file. Only
+        finished blocks go to the file, so a crash never leaves a truncated one.
+        """
+        import time
+        cpu_clock = getattr(time, 'thread_time', time.process_time if python3 else time.clock)  # CPU time of this thread where supported
+        start = cpu_clock()
+
+        text = self._file.getvalue()
+        self._file.seek(0)
+        self._file.truncate()
+        if text:
+            if self._compressor is None:
+                if self.compression == 'gzip':
+                    import zlib
+                    self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 gives a gzip header and trailer
+                else:
+                    import lzma
+                    self._compressor = lzma.LZMACompressor(lzma.FORMAT_XZ)
+            data = text.encode('utf-8') if python3 else text
+            compressed = self._compressor.compress(data)
+            self._block.append(compressed)
+            self.compression_stats['bytes_in'] += len(data)
+            self.compression_stats['bytes_out'] += len(compressed)
+
+        if self._compressor is not None and (end_block or self._block_rows >= self.block_size):
+            compressed = self._compressor.flush()
+            self._block.append(compressed)
+            self.compression_stats['bytes_out'] += len(compressed)
+            self._disk.write(b''.join(self._block))
+            self._block = []
+            self._compressor = None
+            self._block_rows = 0
+            self._disk.flush()  # hand the finished block to the OS so it survives a crash of python
+
+        self.compression_stats['cpu'] += cpu_clock() - start
+
+    def _freeze_schema(self, trial):
+        """Fixes the columns and compiles the row encoder. Writes the header."""
+        import operator
+
+        # Check that all column_order are present in the trial
+        missing = [column for column in self.column_order if column not in trial]
+        if missing:
+            raise ValueError('A column in column_order was not present in the trial dictionary: %s' % missing)
+
+        # column_order first. Then the rest in the order of the trial.
+        self.fieldnames = list(self.column_order) + [key for key in trial if key not in self.column_order]
+        self._columns = frozenset(self.fieldnames)
+
+        # itemgetter looks up all columns in one C call. It returns a single value (not a tuple) for one column.
+        if len(self.fieldnames) == 1:
+            column = self.fieldnames[0]
+            self._encode = lambda trial: (trial[column],)
+        else:
+            self._encode = operator.itemgetter(*self.fieldnames)
+
+        self.writer.writerow(self.fieldnames)
+        if self._journal is not None:
+            self._journal.write(_journal_record(b'H', self.fieldnames))
+
+    def _write_extras(self, trial):
+        """Saves values of columns which were not in the first trial to the extra columns file."""
+        import csv
+        extras = [key for key in trial if key not in self._columns]
+        if not extras:
+            return
+        if self._extra_file is None:
+            filename = self._name + ' extra columns.csv'
+            self._extra_file = open(filename, 'a', newline='') if python3 else open(filename, 'ab')
+            self._extra_writer = csv.writer(self._extra_file)
+            self._extra_writer.writerow(['row', 'column', 'value'])
+        self._extra_writer.writerows([(self._rows + 1, key, trial[key]) for key in extras])
 
     def write(self, trial):
         """Saves a trial to buffer. :trial: a dictionary"""
-        # Write header and add fieldnames on first trial
-        if self.writer.fieldnames is None:
-            self.writer.fieldnames = list(trial.keys())
+        if self._background is not None:
+            # Check here rather than on the writer thread, where an error would stop the writer
+            for column in self.column_order:
+                if column not in trial:
+                    raise ValueError('A column in column_order was not present in the trial dictionary: %s' % [column for column in self.column_order if column not in trial])
+            self._background.put(trial.copy())  # copy so later changes to trial doesn't end up in the file
+        else:
+            self._write_row(trial)
 
-        # Check that all column_order are present in the trial
-        if len(set(self.column_order) - set(list(trial.keys()))) != 0:
-            raise(ValueError('A column in column_order was not present in the trial dictionary'))
+    def _write_row(self, trial):
+        """Writes a trial to the file object."""
+        # Fix the columns and write header on first trial
+        if self._encode is None:
+            self._freeze_schema(trial)
+
+        # Now write data. The slow path only runs when the columns differ from the first trial.
+        try:
+            row = self._encode(trial)
+            if len(trial) != len(self.fieldnames):
+                self._write_extras(trial)
+        except KeyError:
+            missing = [column for column in self.column_order if column not in trial]
+            if missing:
+                raise ValueError('A column in column_order was not present in the trial dictionary: %s' % missing)
+            row = [trial.get(column, '') for column in self.fieldnames]
+            self._write_extras(trial)
 
-        # Enforce order on first columns. Then add the last in "random" order.
-        if len(trial) > len(self.column_order):
-            self.writer.fieldnames = self.column_order + list(set(list(trial.keys())) - set(self.column_order))
+        # Journal before the csv so that the trial survives a crash during the csv write
+        if self._journal is not None:
+            self._journal.write(_journal_record(b'R', trial))
+            self._journaled += 1
+            if self._journaled >= self._journal_group:
+                self._fsync(self._journal.fileno())
+                self._journaled = 0
 
-        # Write header if it hasn't been
-        if not self._header_written:
-            self.writer.writeheader()
-            self._header_written = True
+        self.writer.writerow(row)  # Works both in python2 and python3
+        self._rows += 1
+        if self.compression:
+            self._block_rows += 1
 
-        # Now write data
-        self.writer.writerow(trial)  # Works both in python2 and python3
+        # Sync to disk if the policy says so
+        self._unsynced += 1
+        if self.sync_every and self._unsynced >= self.sync_every:
+            self._sync()
+        elif self.sync_interval and _clock() - self._last_sync >= self.sync_interval:
+            self._sync()
+
+    def _write_batch(self, trials):
+        """Called on the background thread in threaded mode. One flush per batch."""
+        for trial in trials:
+            self._write_row(trial)
+        if self.compression:
+            self._compress()
+        self._file.flush()
+
+    def _sync(self):
+        """Pushes python's buffer to the OS and forces the OS to put it on the disk."""
+        start = _clock()
+        if self.compression:
+            self._compress(end_block=True)
+        self._disk.flush()
+        self._fsync(self._disk.fileno())
+        if self._extra_file is not None:
+            self._extra_file.flush()
+        if self._journal is not None:
+            self._fsync(self._journal.fileno())
+            self._journaled = 0
+        self._last_sync = _clock()
+        self.sync_durations.append(self._last_sync - start)
+        self._unsynced = 0
+
+    def close(self):
+        """Writes everything that is waiting in threaded mode, syncs and closes the file. Safe to call more than once."""
+        try:
+            if self._background is not None:
+                self._background.close()
+            if not self._file.closed and self._unsynced:
+                self._sync()
+        finally:  # close the files even if the writer thread failed
+            for f in (self._file, self._disk, self._journal, self._extra_file):
+                if f is not None and not f.closed:
+                    f.close()
+
+    def stats(self):
+        """
+        Returns a dict with the number of syncs to disk and how long they took
+        (in seconds). In threaded mode, it also has the number of writes, the
+        queue high-water mark and percentiles of how long write() took.
+        With compression, it also has the compression ratio and the CPU time
+        (in seconds) spent compressing.
+        """
+        durations = sorted(self.sync_durations)
+        stats = {
+            'syncs': len(durations),
+            'sync_total': sum(durations),
+            'sync_median': _percentile(durations, 50),
+            'sync_max': durations[-1] if durations else float('nan')
+        }
+        if self.compression:
+            stats['compression_ratio'] = self.compression_stats['bytes_in'] / float(max(self.compression_stats['bytes_out'], 1))
+            stats['compression_cpu'] = self.compression_stats['cpu']
+        if self._background is not None:
+            stats.update(self._background.stats())
+        return stats
 
     def flush(self):
-        """Saves current content to file.
-        This will happen automatically when the script terminates.
-        Only do this if you fear a hard crash. It's mostly fast (< 1 ms) but can be slow (up to 30 ms)
+        """Forces data written so far onto the disk.
+        This will happen automatically when the file is closed or the script terminates.
+        Only do this if you fear a hard crash. Returns the duration of the sync in seconds.
+        It's usually well below a millisecond but depends on the disk, so
+        do it where timing doesn't matter, e.g. while waiting for a response.
         """
-        self._file.close()
-        self._setup_file()
+        if self._background is not None:
+            self._background.wait()  # the writer thread is idle from here on
+        self._sync()
+        return self.sync_durations[-1]
+
+
+def _journal_record(kind, content):
+    """
+    Returns a journal record as bytes: payload length and crc32 as two
+    little-endian uint32, followed by the payload which is a kind-byte
+    (b'H' for header/column order or b'R' for a trial) and the content as JSON.
+    """
+    import json
+    import struct
+    import zlib
+    payload = kind + json.dumps(content, default=str).encode('utf-8')  # default=str handles e.g. numpy numbers
+    return struct.pack('<II', len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def recover(path, output=None):
+    """
+    Rebuilds a csv from the journal written by csv_writer(journal=True).
+    Reading stops at the first incomplete or corrupted record, which is
+    what a crash in the middle of a write leaves behind. Returns the
+    filename of the recovered csv.
+
+    :path: the csv file (its journal is path + '.journal') or the journal itself.
+    :output: filename of the recovered csv. Defaults to the csv name with " recovered" added.
+
+    Use like::
+
+        ppc.recover('data/participant1 (2019-02-14 10-32-11).csv')
+    """
+    import csv
+    import json
+    import struct
+    import zlib
+
+    journal_file = path if path.endswith('.journal') else path + '.journal'
+    if output is None:
+        output = journal_file[:-len('.journal')]
+        for extension in ['.gz', '.xz', '.csv']:
+            if output.endswith(extension):
+                output = output[:-len(extension)]
+        output += ' recovered.csv'
+
+    with open(journal_file, 'rb') as f:
+        data = f.read()
+
+    # Parse records until the end or until a torn/corrupt record
+    column_order, trials = [], []
+    position, header_size = 0, struct.calcsize('<II')
+    while position + header_size <= len(data):
+        length, checksum = struct.unpack_from('<II', data, position)
+        payload = data[position + header_size:position + header_size + length]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+            break
+        content = json.loads(payload[1:].decode('utf-8'))
+        if payload[:1] == b'H':
+            column_order = content
+        else:
+            trials.append(content)
+        position += header_size + length
+    torn = len(data) - position
+
+    # column_order first, then the rest in the order they were first seen
+    fieldnames = list(column_order)
+    seen = set(fieldnames)
+    for trial in trials:
+        for key in trial:
+            if key not in seen:
+                seen.add(key)
+                fieldnames.append(key)
+
+    with (open(output, 'w', newline='') if python3 else open(output, 'wb')) as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(trials)
+
+    print('recovered', len(trials), 'trials to', output, '(ignored %i bytes of incomplete data)' % torn if torn else '')
+    return output
+
+
+class npy_writer(object):
+    # Column kinds from least to most general. A column is promoted when a trial doesn't fit its kind.
+    _KINDS = ['b', 'i', 'f', 'U']
+    _DTYPES = {'b': 'bool', 'i': 'int64', 'f': 'float64'}
+
+    def __init__(self, filename_prefix='', folder='', column_order=[], chunk_size=10000):
+        """
+        Like csv_writer but saves trials as typed numpy columns in binary
+        .npy files. Use it for frame-by-frame logging and other high-rate
+        numeric data: no float-to-text formatting during the experiment,
+        files are several times smaller and load_npy() loads them instantly.
+
+        The type of each column is inferred from the first trial: bool, int,
+        float or text. A column is promoted to a more general type if a later
+        trial needs it (e.g. an int column receives a float). Missing values
+        in later trials become NaN (numbers) or '' (text). Columns which were
+        not in the first trial are ignored with a warning.
+
+        :filename_prefix: (str) would usually be the id of the participant
+        :folder: (str) optionally use/create a folder.
+        :column_order: (list) The columns to put first. Some or all.
+        :chunk_size: (int) number of trials kept in memory. When full, they
+            are handed to a background thread which saves them to disk as
+            one file per column, so write() never waits for the disk.
+
+        Use like:
+
+            writer = ppc.npy_writer('participant1', folder='data')
+            for frame in range(FRAMES):
+                writer.write({'frame': frame, 'time': clock.getTime(), 'x': stim.pos[0]})
+            writer.close()  # also happens automatically when the script terminates
+
+            data = ppc.load_npy(writer.save_folder)  # data['time'] is a numpy array
+        """
+        import atexit
+        import os
+        import time
+        import numpy as np
+
+        self._np = np
+        self.column_order = column_order
+        self.chunk_size = chunk_size
+        self.fieldnames = None  # set on the first trial
+        self._n = 0  # trials in the current chunk
+        self._chunks = []  # number of trials in each chunk handed to the writer thread
+        self._ignored = set()
+        self._background = _BackgroundWriter(self._save_chunks, queue_size=8, batch_size=8)
+
+        # All chunks and a columns.json describing them go into one folder per session
+        if folder:
+            folder += '/'
+        self.save_folder = '%s%s (%s)' % (folder, filename_prefix, time.strftime('%Y-%m-%d %H-%M-%S', time.localtime()))
+        if not os.path.isdir(self.save_folder):
+            os.makedirs(self.save_folder)
+        atexit.register(self.close)
+
+    def _kind(self, value):
+        """Returns the column kind which can hold value"""
+        import numbers
+        if isinstance(value, (bool, self._np.bool_)):
+            return 'b'
+        if isinstance(value, numbers.Integral):
+            return 'i'
+        if isinstance(value, numbers.Real):
+            return 'f'
+        return 'U'
+
+    def _new_buffer(self, kind):
+        """A preallocated buffer for a chunk. Text is kept as python objects until saved."""
+        if kind == 'U':
+            return [''] * self.chunk_size
+        return self._np.zeros(self.chunk_size, dtype=self._DTYPES[kind])
+
+    def _freeze_schema(self, trial):
+        """Fixes the columns and their initial kinds."""
+        missing = [column for column in self.column_order if column not in trial]
+        if missing:
+            raise ValueError('A column in column_order was not present in the trial dictionary: %s' % missing)
+        self.fieldnames = list(self.column_order) + [key for key in trial if key not in self.column_order]
+        self._kinds = [self._kind(trial[column]) for column in self.fieldnames]
+        self._classes = [type(trial[column]) for column in self.fieldnames]  # fast check whether a value fits
+        self._buffers = [self._new_buffer(kind) for kind in self._kinds]
+
+    def _promote(self, index, kind):
+        """Converts the current chunk of a column to a more general kind"""
+        old = self._buffers[index][:self._n]
+        self._buffers[index] = self._new_buffer(kind)
+        if kind == 'U':
+            self._buffers[index][:self._n] = [str(value) for value in old]
+        else:
+            self._buffers[index][:self._n] = old
+        self._kinds[index] = kind
+
+    def write(self, trial):
+        """Saves a trial to the current chunk. :trial: a dictionary"""
+        if self.fieldnames is None:
+            self._freeze_schema(trial)
+
+        n, missing = self._n, 0
+        for index, column in enumerate(self.fieldnames):
+            value = trial.get(column, None)
+            if value is None:  # missing value
+                missing += 1
+                if column in self.column_order:
+                    raise ValueError('A column in column_order was not present in the trial dictionary: %s' % column)
+                if self._kinds[index] in 'bi':
+                    self._promote(index, 'f')
+                value = '' if self._kinds[index] == 'U' else float('nan')
+            elif value.__class__ is not self._classes[index]:  # slow path for a new type
+                kind = self._kind(value)
+                if self._KINDS.index(kind) > self._KINDS.index(self._kinds[index]):
+                    self._promote(index, kind)
+                if self._kinds[index] == 'U':
+                    value = str(value)
+            self._buffers[index][n] = value
+
+        if len(trial) + missing > len(self.fieldnames):
+            self._warn_extras(trial)
+
+        self._n = n + 1
+        if self._n == self.chunk_size:
+            self._spill()
+
+    def _warn_extras(self, trial):
+        """Warns once about each column which was not in the first trial"""
+        import warnings
+        for key in trial:
+            if key not in self.fieldnames and key not in self._ignored:
+                self._ignored.add(key)
+                warnings.warn('npy_writer ignores column "%s" because it was not in the first trial' % key)
+
+    def _spill(self):
+        """Hands the trials in memory to the writer thread as a new chunk and starts on fresh buffers."""
+        if not self._n:
+            return
+        self._chunks.append(self._n)
+        full, self._buffers = self._buffers, [self._new_buffer(kind) for kind in self._kinds]
+        chunk = (len(self._chunks) - 1, self._n, full, list(self._kinds), list(self._chunks))
+        self._n = 0
+        self._background.put(chunk)  # last, since the writer thread may take over python right away
+
+    def _save_chunks(self, chunks):
+        """Called on the writer thread. Saves one file per column and chunk and updates columns.json."""
+        import json
+        import os
+        np = self._np
+        for chunk, n, buffers, kinds, sizes in chunks:
+            for index, buffer in enumerate(buffers):
+                values = np.array(buffer[:n], dtype=str) if kinds[index] == 'U' else buffer[:n]
+                np.save(os.path.join(self.save_folder, '%05i_%03i.npy' % (chunk, index)), values)
+
+            # Describe the chunks. Written to a temporary file first so that it's never half-written.
+            info_file = os.path.join(self.save_folder, 'columns.json')
+            with open(info_file + '.tmp', 'w') as f:
+                json.dump({'columns': self.fieldnames, 'chunks': sizes}, f)
+            getattr(os, 'replace', os.rename)(info_file + '.tmp', info_file)  # os.replace is python 3 only
+
+    def flush(self):
+        """Saves the trials in memory as a new chunk and waits until all chunks are on disk."""
+        self._spill()
+        self._background.wait()
+
+    def close(self):
+        """Saves the last trials. Safe to call more than once."""
+        self._spill()
+        self._background.close()
+
+    def stats(self):
+        """Returns a dict with statistics of handing chunks to the writer thread. See csv_writer.stats()."""
+        return self._background.stats()
+
+
+def load_npy(path, concatenate=True):
+    """
+    Loads what npy_writer saved. Returns a dict with a numpy array for
+    each column, in the original column order (an OrderedDict).
+
+    The files are memory-mapped, so only the data you use is read from
+    disk. But if the session has several chunks, concatenating them reads
+    them all into memory. For long sessions, use concatenate=False to get
+    a list of memory-mapped chunks for each column instead.
+
+    :path: the folder of the session, i.e. npy_writer.save_folder.
+    :concatenate: (bool) join the chunks of each column into one array.
+    """
+    import json
+    import os
+    import numpy as np
+
+    with open(os.path.join(path, 'columns.json')) as f:
+        info = json.load(f)
+
+    data = collections.OrderedDict()
+    for index, column in enumerate(info['columns']):
+        chunks = [np.load(os.path.join(path, '%05i_%03i.npy' % (chunk, index)), mmap_mode='r') for chunk in range(len(info['chunks']))]
+        if any(chunk.dtype.kind == 'U' for chunk in chunks):  # a column promoted to text in a later chunk
+            chunks = [chunk.astype(str) for chunk in chunks]
+        if not concatenate:
+            data[column] = chunks
+        else:
+            data[column] = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+    return data
+
+
+# Values which sqlite3 stores as they are. The rest are converted by sqlite_writer._value.
+_sql_types = (int, float, str, bytes) if python3 else (int, long, float, str, unicode)  # long and unicode only exist in python 2
+
+
+def _sql_name(name):
+    """Quotes a table or column name for SQL"""
+    return '"%s"' % ('%s' % (name,)).replace('"', '""')  # not str(name), which fails for non-ascii unicode in python 2
+
+
+class sqlite_writer(object):
+    def __init__(self, database='data.sqlite', experiment='trials', session={}, column_order=[], index=[], queue_size=1000, batch_size=100):
+        """
+        Like csv_writer but saves trials to a table in an SQLite database.
+        All participants and experiments can go in the same database file,
+        so you can query e.g. all trials of a condition across participants
+        instead of reading hundreds of csv files. Trials are written and
+        committed in batches by a background thread, so write() only puts
+        a copy of the trial in a queue.
+
+        :database: (str) the database file. Created if it doesn't exist.
+        :experiment: (str) name of the table with the trials of this experiment.
+        :session: (dict) information about the participant and session, e.g.
+            the answers from the intro dialogue. Saved once in the "sessions"
+            table instead of on every trial. Trials get a "_session" column
+            with the id of the session (sessions._id). The sessions table
+            also has the columns _experiment and _started. These names can't
+            be used in session or trials.
+        :column_order: (list) The columns to put first in the table. Some or all.
+        :index: (list) columns to index for fast queries, e.g. ['condition'].
+        :queue_size: (int) maximum number of trials waiting to be written.
+        :batch_size: (int) maximum number of trials per transaction.
+
+        Use like:
+
+            writer = ppc.sqlite_writer('data/experiments.sqlite', 'gabor', session=V, index=['condition'])
+            writer.write(trial)  # after each trial
+
+            # Later, in the analysis:
+            import sqlite3
+            db = sqlite3.connect('data/experiments.sqlite')
+            db.execute('SELECT * FROM gabor JOIN sessions ON gabor._session = sessions._id WHERE gabor.condition = ?', ['falseFix'])
+        """
+        import atexit
+        import os
+        import sqlite3
+        import time
+
+        self.database = database
+        self.experiment = experiment
+        self.session = dict(session)
+        self.column_order = column_order
+        self.index = index
+        self.fieldnames = None  # all columns known so far. Set on the first trial.
+        reserved = [key for key in self.session if key in ('_id', '_experiment', '_started')]
+        if reserved:
+            raise ValueError('These names are used by sqlite_writer and can not be in session: %s' % reserved)
+
+        folder = os.path.dirname(database)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # Register the session on this thread so that errors show up immediately.
+        # The writer thread uses its own connection since sqlite connections can't be shared between threads.
+        db = sqlite3.connect(database)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer. Persists in the database file.
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (_id INTEGER PRIMARY KEY AUTOINCREMENT, _experiment TEXT, _started TEXT)')
+            self._add_columns(db, 'sessions', self.session)
+            columns = ['_experiment', '_started'] + list(self.session)
+            values = [experiment, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())] + [self._value(value) for value in self.session.values()]
+            self.session_id = db.execute('INSERT INTO sessions (%s) VALUES (%s)' % (', '.join(map(_sql_name, columns)), ', '.join('?' * len(columns))), values).lastrowid
+            db.commit()
+        finally:
+            db.close()  # also on errors. Otherwise the open transaction keeps the database locked.
+
+        self._db = None
+        self._background = _BackgroundWriter(self._write_batch, queue_size=queue_size, batch_size=batch_size)
+        atexit.register(self.close)
+
+    @staticmethod
+    def _value(value):
+        """Converts value to something sqlite can store, e.g. numpy numbers to python numbers"""
+        if value is None or isinstance(value, _sql_types):
+            return value
+        return value.item() if hasattr(value, 'item') else str(value)
+
+    @staticmethod
+    def _add_columns(db, table, columns):
+        """Adds columns which are not already in the table"""
+        existing = set(row[1] for row in db.execute('PRAGMA table_info(%s)' % _sql_name(table)))
+        for column in columns:
+            if column not in existing:
+                db.execute('ALTER TABLE %s ADD COLUMN %s' % (_sql_name(table), _sql_name(column)))
+
+    def write(self, trial):
+        """Saves a trial. :trial: a dictionary"""
+        # Check here rather than on the writer thread, where an error would lose the rest of the batch
+        for column in self.column_order:
+            if column not in trial:
+                raise ValueError('A column in column_order was not present in the trial dictionary: %s' % [column for column in self.column_order if column not in trial])
+        if '_session' in trial:
+            raise ValueError('"_session" is used by sqlite_writer and can not be a column in trials')
+        self._background.put(trial.copy())  # copy so later changes to trial doesn't end up in the database
+
+    def _write_batch(self, trials):
+        """Called on the background thread. One transaction per batch."""
+        import sqlite3
+        table = _sql_name(self.experiment)
+        if self._db is None:
+            self._db = sqlite3.connect(self.database, check_same_thread=False)  # close() closes it when the thread has stopped
+            self._db.execute('PRAGMA synchronous=NORMAL')  # with WAL, this is safe against corruption and only syncs at checkpoints
+
+        rows = []
+        for trial in trials:
+            # Create the table on the first trial. Add columns when new ones show up.
+            if self.fieldnames is None:
+                self.fieldnames = list(self.column_order) + [key for key in trial if key not in self.column_order]
+                self._db.execute('CREATE TABLE IF NOT EXISTS %s (_session INTEGER REFERENCES sessions(_id))' % table)
+                self._add_columns(self._db, self.experiment, self.fieldnames)
+                for column in ['_session'] + list(self.index):
+                    self._db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (_sql_name(self.experiment + '_' + column), table, _sql_name(column)))
+            elif any(key not in self.fieldnames for key in trial):
+                new = [key for key in trial if key not in self.fieldnames]
+                self._add_columns(self._db, self.experiment, new)
+                self.fieldnames += new
+
+            rows.append([self.session_id] + [self._value(trial.get(column)) for column in self.fieldnames])
+
+        # Insert the batch in a single transaction
+        columns = ['_session'] + self.fieldnames
+        with self._db:
+            self._db.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(map(_sql_name, columns)), ', '.join('?' * len(columns))),
+                                 [row + [None] * (len(columns) - len(row)) for row in rows])
+
+    def flush(self):
+        """Waits until all trials so far are committed to the database."""
+        self._background.wait()
+
+    def close(self):
+        """Writes everything that is waiting and closes the database. Safe to call more than once."""
+        self._background.close()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        """Returns a dict with the number of writes, the queue high-water mark and percentiles of how long write() took (in seconds)."""
+        return self._background.stats()
+
+
+class SimulatedVSync(object):
+    """
+    A stand-in for win.flip() on computers without a monitor, e.g. to test
+    or benchmark getActualFrameRate(). Each call returns the time of the
+    next vertical blank of an imaginary monitor. Use like::
+
+        ppc.getActualFrameRate(flip=ppc.SimulatedVSync(rate=60, drop=0.01))
+
+    :rate: (float) refresh rate in Hz.
+    :drop: (float) probability that a flip misses a vertical blank (the frame lasts two or more refreshes).
+    :double: (float) probability that a flip returns without waiting, as on computers which don't sync to the monitor.
+    :jitter: (float) SD in seconds of noise added to the returned times.
+    :realtime: (bool) if True, actually wait until the vertical blank. If False, return immediately.
+    :seed: seed for the random numbers, for reproducible tests.
+    """
+    def __init__(self, rate=60.0, drop=0.0, double=0.0, jitter=0.0, realtime=False, seed=None):
+        import random
+        self.period = 1.0 / rate
+        self.drop = drop
+        self.double = double
+        self.jitter = jitter
+        self.realtime = realtime
+        self._random = random.Random(seed)
+        self._vsync = _clock() if realtime else 0.0  # time of the last vertical blank
 
+    def __repr__(self):
+        return 'SimulatedVSync(rate=%g, drop=%g, double=%g, jitter=%g, realtime=%s)' % (1 / self.period, self.drop, self.double, self.jitter, self.realtime)
 
-def getActualFrameRate(frames=1000):
+    def __call__(self):
+        random = self._random.random
+        if not (self.double and random() < self.double):
+            self._vsync += self.period
+            while self.drop and random() < self.drop:
+                self._vsync += self.period
+        if self.realtime:
+            import time
+            remaining = self._vsync - _clock()
+            if remaining > 0.002:
+                time.sleep(remaining - 0.002)
+            while _clock() < self._vsync:
+                pass
+        return self._vsync + (self._random.gauss(0, self.jitter) if self.jitter else 0.0)
+
+
+class FrameRateResult(object):
+    """
+    The result of getActualFrameRate(). Times are in seconds:
+
+        :timestamps: numpy array with the time of each flip
+        :intervals: numpy array with the time between flips
+        :period: the estimated refresh period. rate is 1 / period in Hz.
+            Estimated by fitting a line through the flip times against the
+            number of refreshes since the first flip. See estimate_period().
+            NaN if the flips don't wait for the monitor. Then error says why.
+        :error: None, or why the period could not be estimated (str)
+        :mean, sd, min, max, p1, p5, p50, p95, p99: statistics of the intervals
+        :dropped: number of refreshes missed in total, i.e. frames shown too long
+        :dropped_frames: indices of intervals which lasted two or more periods
+        :doubled_frames: indices of intervals shorter than half a period, i.e. flips that didn't wait for the monitor
+    """
+    def __init__(self, timestamps):
+        import numpy as np
+        self.timestamps = timestamps
+        self.intervals = np.diff(timestamps)
+        intervals = self.intervals
+        self.mean, self.sd = float(intervals.mean()), float(intervals.std())
+        self.min, self.max = float(intervals.min()), float(intervals.max())
+        self.p1, self.p5, self.p50, self.p95, self.p99 = [float(value) for value in np.percentile(intervals, [1, 5, 50, 95, 99])]
+        try:
+            self.period = estimate_period(timestamps)
+            self.error = None
+        except ValueError as error:  # e.g. no vsync. The statistics of the intervals are still useful.
+            self.period = float('nan')
+            self.error = str(error)
+        self.rate = 1 / self.period
+
+        # Count refreshes in each interval to detect dropped and doubled frames
+        refreshes = np.round(intervals / self.period)
+        self.dropped_frames = np.flatnonzero(refreshes >= 2)
+        self.dropped = int((refreshes[self.dropped_frames] - 1).sum())
+        self.doubled_frames = np.flatnonzero(intervals < 0.5 * self.period)
+
+    def __repr__(self):
+        durations = 'shortest duration was %.3f ms and longest duration was %.3f ms. 1%% and 99%% percentiles: %.3f and %.3f ms' % (self.min * 1000, self.max * 1000, self.p1 * 1000, self.p99 * 1000)
+        if self.error:
+            return '\n'.join([
+                'average frame duration was %.3f ms (SD %.3f ms)' % (self.mean * 1000, self.sd * 1000),
+                durations,
+                'the refresh period is unknown. %s' % self.error
+            ])
+        return '\n'.join([
+            'average frame duration was %.3f ms (SD %.3f ms). The refresh period is %.4f ms' % (self.mean * 1000, self.sd * 1000, self.period * 1000),
+            'corresponding to a framerate of %.3f Hz' % self.rate,
+            '60 frames on your monitor takes %.3f ms' % (self.period * 60 * 1000),
+            durations,
+            '%i of %i frames lasted too long (%i refreshes missed). %i flips did not wait for the monitor.' % (len(self.dropped_frames), len(self.intervals), self.dropped, len(self.doubled_frames))
+        ])
+
+
+def estimate_period(timestamps):
+    """
+    Returns the refresh period in seconds estimated from flip times. Each
+    flip is assigned the number of refreshes since the first flip, so
+    dropped frames count as the right number of refreshes instead of
+    inflating the average. Flips that didn't wait for the monitor are
+    discarded. The period is the slope of a least-squares line through
+    flip times against refresh numbers. Flips far from the line (late
+    flips, hiccups of the clock) are discarded and the line is refitted.
+
+    Raises ValueError if the flips don't seem to wait for the monitor, e.g.
+    if most are less than 1 ms apart or not locked to a common period.
+
+    :timestamps: numpy array or list of flip times in seconds.
+    """
+    import numpy as np
+    timestamps = np.asarray(timestamps, dtype=float)
+    intervals = np.diff(timestamps)
+    if len(intervals) < 10:
+        raise ValueError('At least 11 flips are needed to estimate the refresh period. Got %i.' % len(timestamps))
+
+    # Rough estimate. Ignore flips that didn't wait, which are much shorter than the rest.
+    waited = intervals[intervals > 0.25 * np.percentile(intervals, 90)]
+    period = np.median(waited) if len(waited) else 0.0
+    if not period > 0.001:
+        raise ValueError('The flips are %.3f ms apart (median). flip() does not seem to wait for the vertical blank, so the refresh period can not be estimated.' % (period * 1000))
+
+    for iteration in range(3):
+        # Number of refreshes between flips. Discard flips within the same refresh.
+        refreshes = np.round(intervals / period)
+        locked = int((refreshes >= 1).sum())
+        if locked < 10:
+            raise ValueError('Only %i of %i flips waited for a refresh. flip() does not seem to wait for the vertical blank.' % (locked, len(intervals)))
+        keep = np.concatenate([[True], refreshes >= 1])
+        times = timestamps[keep]
+        numbers = np.concatenate([[0], np.cumsum(refreshes[refreshes >= 1])])
+
+        # Fit, discard outliers and refit
+        slope, intercept = np.polyfit(numbers, times, 1)
+        residuals = times - (intercept + slope * numbers)
+        deviation = np.median(np.abs(residuals - np.median(residuals))) * 1.4826  # robust SD
+        good = np.abs(residuals) <= max(3 * deviation, 1e-9)
+        if good.sum() > 2:
+            slope, intercept = np.polyfit(numbers[good], times[good], 1)
+        period = slope
+        if not period > 0.001:
+            raise ValueError('The estimated refresh period is %.3f ms. flip() does not seem to wait for the vertical blank.' % (period * 1000))
+
+    if deviation > period / 4:
+        raise ValueError('The flip times are not locked to a refresh period (SD %.3f ms around a period of %.3f ms). flip() does not seem to wait for the vertical blank.' % (deviation * 1000, period * 1000))
+    return float(period)
+
+
+def frame_interval(win=None, flip=None, frames=300, max_age=7 * 24 * 3600, cache_file=None, recalibrate=False):
+    """
+    Returns the refresh period of the monitor in seconds. It's measured once
+    and then cached on disk for this computer, display mode and psychopy
+    version, so later calls take microseconds. Use it instead of
+    hard-coding e.g. frameInterval = 0.01667::
+
+        frameInterval = ppc.frame_interval(win)
+
+    :win: (psychopy Window) the window to measure on. Its size, screen and
+        fullscr are part of the cache key. If None, getActualFrameRate() opens a window.
+    :flip: function which waits for the next frame. Defaults to win.flip.
+        If it's not the flip of a window, repr(flip) is part of the cache
+        key, so give objects a __repr__ which describes them (like
+        SimulatedVSync has). Flips of windows are keyed by the window.
+    :frames: number of frames to measure on.
+    :max_age: (float) seconds before the calibration is redone.
+    :cache_file: (str) JSON file with calibrations. Default: .ppc_frame_interval.json in your home folder.
+    :recalibrate: (bool) measure again even if there's a valid calibration.
+
+    Raises ValueError if flip doesn't wait for the monitor. See estimate_period().
+    """
+    import json
+    import os
+    import platform
+    import time
+
+    # Cache key: computer, display mode and psychopy version
+    try:
+        import psychopy
+        psychopy_version = psychopy.__version__
+    except ImportError:
+        psychopy_version = 'none'
+    mode = 'default'
+    window = win if win is not None else getattr(flip, '__self__', None)  # win.flip is a method of the window
+    if window is not None and hasattr(window, 'size'):
+        mode = '%ix%i screen %s%s' % (window.size[0], window.size[1], getattr(window, 'screen', 0), ' fullscreen' if getattr(window, 'fullscr', False) else '')
+    elif flip is not None:
+        mode = '%s.%s' % (getattr(flip, '__module__', ''), flip.__name__) if hasattr(flip, '__name__') else repr(flip)
+    key = '%s / %s / psychopy %s' % (platform.node(), mode, psychopy_version)
+
+    cache_file = cache_file or os.path.join(os.path.expanduser('~'), '.ppc_frame_interval.json')
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    entry = cache.get(key)
+    if entry and not recalibrate and time.time() - entry['time'] < max_age:
+        return entry['period']
+
+    # Calibrate and save
+    if flip is None and win is not None:
+        flip = win.flip
+    result = getActualFrameRate(frames, flip, verbose=False)
+    if result.error:
+        raise ValueError(result.error)  # never cache a bogus period
+    cache[key] = {'period': result.period, 'rate': result.rate, 'frames': frames, 'dropped': result.dropped, 'time': time.time(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    return result.period
+
+
+def getActualFrameRate(frames=1000, flip=None, verbose=True):
     """
     Measures the actual framerate of your monitor. It's not always as clean as
-    you'd think. Prints various useful information.
+    you'd think. Prints various useful information and returns a FrameRateResult.
         :frames: number of frames to do test on.
+        :flip: function which waits for the next frame, e.g. win.flip of an
+            open window. If flip returns a time (like psychopy's win.flip()),
+            that is used. Otherwise, the time is taken just after flip.
+            If None, a psychopy Window is opened and closed for the test.
+            Use SimulatedVSync() to test without a monitor.
+        :verbose: (bool) print the summary.
+
+    If the flips don't wait for the monitor, the period and rate of the
+    result are NaN and result.error says why. The statistics of the
+    intervals are still there.
     """
-    from psychopy import visual, core
+    import numbers
+    import numpy as np
 
-    # Set stimuli up
-    durations = []
-    clock = core.Clock()
-    win = visual.Window(color='pink')
+    # Set window up
+    win = None
+    if flip is None:
+        from psychopy import visual, core
+        win = visual.Window(color='pink')
 
-    # Show a brief instruction / warning
-    visual.TextStim(win, text='Now wait and \ndon\'t do anything', color='black').draw()
-    win.flip()
-    core.wait(1.5)
+        # Show a brief instruction / warning
+        visual.TextStim(win, text='Now wait and \ndon\'t do anything', color='black').draw()
+        win.flip()
+        core.wait(1.5)
+        flip = win.flip
 
-    # blank screen and synchronize clock to vertical blanks
-    win.flip()
-    clock.reset()
+    # Blank screen and synchronize to vertical blanks. Check whether flip returns times.
+    flip()
+    timestamps = np.empty(frames + 1)  # preallocated
+    first = flip()
+    if isinstance(first, numbers.Real):
+        timestamps[0] = first
+        for i in range(1, frames + 1):  # Run the test!
+            timestamps[i] = flip()
+    else:
+        timestamps[0] = _clock()
+        for i in range(1, frames + 1):  # Run the test!
+            flip()
+            timestamps[i] = _clock()
 
-    # Run the test!
-    for i in range(frames):
-        win.flip()
-        durations += [clock.getTime()]
-        clock.reset()
+    if win is not None:
+        win.close()
+
+    result = FrameRateResult(timestamps)
+    if verbose:
+        print(result)
+    return result
+
+
+# psychopy's default DKL --> RGB conversion matrix. Columns are luminance,
+# L-M and S. Rows are R, G and B. Use your own from a monitor calibration.
+DKL_RGB = ((1.0, 1.0, -0.1462),
+           (1.0, -0.39, 0.2094),
+           (1.0, 0.018, -1.0))
+_dkl_matrices = {}  # calibration --> (matrix, inverse)
+
+
+def _dkl_matrix(calibration=None):
+    """
+    Returns (matrix, inverse) for a calibration: None for DKL_RGB, a 3x3
+    matrix or a psychopy Monitor. They are computed once per calibration.
+    """
+    if calibration is None:
+        if None not in _dkl_matrices:
+            _dkl_matrices[None] = _dkl_matrix(DKL_RGB)
+        return _dkl_matrices[None]
+    elif hasattr(calibration, 'getDKL_RGB'):  # psychopy Monitor
+        calibration = calibration.getDKL_RGB()
+        if calibration is None:
+            calibration = DKL_RGB
+    import numpy as np
+    matrix = np.array(calibration, dtype=float)
+    key = matrix.tobytes()
+    if key not in _dkl_matrices:
+        if matrix.shape != (3, 3):
+            raise ValueError('calibration must be a 3x3 DKL to RGB matrix. Got shape %s' % (matrix.shape, ))
+        inverse = np.linalg.inv(matrix)
+        matrix.flags.writeable = inverse.flags.writeable = False
+        _dkl_matrices[key] = (matrix, inverse)
+    return _dkl_matrices[key]
+
+
+def _gamma_encode(rgb, gamma):
+    """
+    From linear rgb (-1 to 1) to values for the graphics card (-1 to 1). gamma
+    is a number, one number per gun, or a lookup table of shape (N, ) or
+    (N, 3) from linear intensity (0 to 1 in N steps) to output (0 to 1).
+    """
+    import numpy as np
+    intensity = np.clip((rgb + 1) / 2, 0, 1)
+    gamma = np.asarray(gamma, dtype=float)
+    if gamma.ndim <= 1 and gamma.size in (1, 3):
+        output = intensity ** (1 / gamma)
+    else:
+        table = gamma.reshape(len(gamma), -1)
+        steps = np.linspace(0, 1, len(table))
+        output = np.empty_like(intensity)
+        for gun in range(3):
+            output[..., gun] = np.interp(intensity[..., gun], steps, table[:, gun % table.shape[1]])
+    return output * 2 - 1
+
+
+def _gamma_decode(rgb, gamma):
+    """The inverse of _gamma_encode()"""
+    import numpy as np
+    output = np.clip((rgb + 1) / 2, 0, 1)
+    gamma = np.asarray(gamma, dtype=float)
+    if gamma.ndim <= 1 and gamma.size in (1, 3):
+        intensity = output ** gamma
+    else:
+        table = gamma.reshape(len(gamma), -1)
+        steps = np.linspace(0, 1, len(table))
+        intensity = np.empty_like(output)
+        for gun in range(3):
+            intensity[..., gun] = np.interp(output[..., gun], table[:, gun % table.shape[1]], steps)
+    return intensity * 2 - 1
+
+
+def dkl2rgb(dkl, calibration=None, gamma=None):
+    """
+    Takes DKL colors and returns the corresponding RGB colors (-1 to 1) like
+    psychopy.tools.colorspacetools.dkl2rgb, but without needing psychopy.
+
+    :dkl: [elevation, azimuth, radius] in degrees, degrees and 0-1. One color
+        or an array of shape (..., 3), e.g. a palette (N, 3) or an image.
+        The result has the same shape.
+    :calibration: 3x3 DKL to RGB matrix or a psychopy Monitor with one.
+        Default: DKL_RGB. Matrices and their inverses are cached.
+    :gamma: optional gamma correction. A number, one per gun, or a lookup
+        table. RGB is clipped to -1 to 1 when this is used.
+    """
+    import numpy as np
+    dkl = np.asarray(dkl, dtype=float)
+    matrix = _dkl_matrix(calibration)[0]
+
+    # Spherical to cartesian [luminance, L-M, S]
+    elevation, azimuth = np.radians(dkl[..., 0]), np.radians(dkl[..., 1])
+    radius = dkl[..., 2]
+    cartesian = np.empty(dkl.shape)
+    cartesian[..., 0] = radius * np.sin(elevation)
+    cartesian[..., 1] = radius * np.cos(elevation) * np.cos(azimuth)
+    cartesian[..., 2] = radius * np.cos(elevation) * np.sin(azimuth)
+
+    rgb = np.dot(cartesian, matrix.T)
+    if gamma is not None:
+        rgb = _gamma_encode(rgb, gamma)
+    return rgb
 
-    win.close()
 
-    # Print summary
+def rgb2dkl(rgb, calibration=None, gamma=None):
+    """
+    Takes RGB colors (-1 to 1) and returns [elevation, azimuth, radius]. The
+    inverse of dkl2rgb(). See it for the arguments. Azimuth is 0 to 360.
+    """
     import numpy as np
-    print('average frame duration was', round(np.average(durations) * 1000, 3), 'ms (SD', round(np.std(durations), 5), ') ms')
-    print('corresponding to a framerate of', round(1 / np.average(durations), 3), 'Hz')
-    print('60 frames on your monitor takes', round(np.average(durations) * 60 * 1000, 3), 'ms')
-    print('shortest duration was ', round(min(durations) * 1000, 3), 'ms and longest duration was ', round(max(durations) * 1000, 3), 'ms')
+    rgb = np.asarray(rgb, dtype=float)
+    if gamma is not None:
+        rgb = _gamma_decode(rgb, gamma)
+    cartesian = np.dot(rgb, _dkl_matrix(calibration)[1].T)
+
+    luminance, lm, s = cartesian[..., 0], cartesian[..., 1], cartesian[..., 2]
+    dkl = np.empty(cartesian.shape)
+    dkl[..., 2] = radius = np.sqrt(luminance ** 2 + lm ** 2 + s ** 2)
+    dkl[..., 0] = np.degrees(np.arcsin(np.clip(luminance / np.where(radius > 0, radius, 1), -1, 1)))
+    dkl[..., 1] = np.degrees(np.arctan2(s, lm)) % 360
+    return dkl
+
+
+class ColorCache(object):
+    """
+    Remembers DKL --> RGB conversions of palettes on disk, so preparing a
+    large palette at startup is a memory-mapped load instead of a
+    conversion. There's one .npy file per calibration, gamma and palette,
+    named by a hash of each, so a new calibration starts new files::
+
+        colors = ppc.ColorCache(my_monitor, gamma=2.2)
+        palette = colors.dkl2rgb(dkl_palette)  # (N, 3) array. Computed and saved the first time.
+        fill = colors.dkl2rgb([0, 45, 1])  # or one color
+
+    Palettes are returned as read-only memory-mapped arrays. Copy one if you
+    want to change it. A palette is identified by its exact values in
+    order, so the same colors in another order or with more colors are a
+    new palette with a new file. Single colors are only kept in memory.
+    In memory, the least recently used palettes and colors are evicted.
+    Files which haven't been used for a while are deleted by prune().
+
+    :calibration: 3x3 DKL to RGB matrix or a psychopy Monitor. See dkl2rgb().
+    :gamma: optional gamma correction. See dkl2rgb().
+    :folder: (str) where to put cache files. Default: .ppc_colors in your home folder.
+    :size: (int) the number of single colors to keep in memory.
+    :palettes: (int) the number of palettes to keep loaded.
+    """
+    def __init__(self, calibration=None, gamma=None, folder=None, size=10000, palettes=10):
+        import hashlib
+        import os
+        import numpy as np
+        self.calibration = _dkl_matrix(calibration)[0]
+        self.gamma = gamma
+        digest = hashlib.sha1(self.calibration.tobytes())
+        if gamma is not None:
+            digest.update(np.asarray(gamma, dtype=float).tobytes())
+        self.hash = digest.hexdigest()[:16]
+        self.folder = folder or os.path.join(os.path.expanduser('~'), '.ppc_colors')
+        self.size = size
+        self.palettes = palettes
+        self.hits = 0  # conversions found in memory or on disk
+        self.misses = 0  # conversions computed
+        self._recent = collections.OrderedDict()  # dkl tuple --> [rgb, gamma corrected rgb]. Least recently used first.
+        self._palettes = collections.OrderedDict()  # palette hash --> memory-mapped [rgb, gamma corrected rgb] rows. Least recently used first.
+
+    def _recall(self, recent, key, size, make):
+        """Returns recent[key] or, if it's not there, make(). recent keeps the size most recently used."""
+        value = recent.pop(key, None)
+        if value is None:
+            value = make()
+            if len(recent) >= size:
+                recent.popitem(last=False)  # closes the memory map of a palette when nothing else uses it
+        else:
+            self.hits += 1
+        recent[key] = value  # now the most recently used
+        return value
+
+    def _convert(self, dkl):
+        """Returns an (N, 6) array of [rgb, gamma corrected rgb] for an (N, 3) array of DKL colors"""
+        import numpy as np
+        rgb = dkl2rgb(dkl, self.calibration)
+        return np.hstack([rgb, _gamma_encode(rgb, self.gamma) if self.gamma is not None else rgb])
+
+    def _load(self, dkl, filename):
+        """Returns the rows of a palette. Loaded from disk, or computed and saved."""
+        import os
+        import numpy as np
+        if os.path.exists(filename):
+            self.hits += 1
+            os.utime(filename, None)  # the modification time is the last use. See prune().
+        else:
+            self.misses += 1
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            with open(filename + '.tmp', 'wb') as f:  # never leave a half-written file
+                np.save(f, self._convert(dkl))
+            getattr(os, 'replace', os.rename)(filename + '.tmp', filename)  # os.replace is python 3 only
+        return np.load(filename, mmap_mode='r')
+
+    def _palette(self, dkl):
+        """Returns the rows of a palette from memory, disk or computed."""
+        import hashlib
+        import os
+        key = hashlib.sha1(dkl.tobytes()).hexdigest()[:16]
+        filename = os.path.join(self.folder, '%s_%s.npy' % (self.hash, key))
+        return self._recall(self._palettes, key, self.palettes, lambda: self._load(dkl, filename))
+
+    def _single(self, key):
+        """Returns the row of one color, computed"""
+        import numpy as np
+        self.misses += 1
+        return self._convert(np.array([key]))[0]
+
+    def dkl2rgb(self, dkl, corrected=True):
+        """
+        Returns RGB for one DKL color or an array of shape (..., 3) like
+        ppc.dkl2rgb(). If corrected, the gamma corrected RGB is returned.
+        """
+        import numpy as np
+        columns = slice(3, 6) if corrected else slice(0, 3)
+        if np.ndim(dkl) == 1:
+            key = tuple(float(value) for value in dkl)
+            return self._recall(self._recent, key, self.size, lambda: self._single(key))[columns].copy()
+
+        dkl = np.ascontiguousarray(dkl, dtype=float)
+        return self._palette(dkl.reshape(-1, 3))[:, columns].reshape(dkl.shape)
+
+    def prune(self, max_age=30 * 24 * 3600):
+        """
+        Deletes cache files in folder which haven't been used for max_age
+        seconds, of all calibrations. Returns the number of deleted files.
+        Do it e.g. at the start of a session.
+        """
+        import os
+        import re
+        import time
+        if not os.path.isdir(self.folder):
+            return 0
+        deleted = 0
+        for name in os.listdir(self.folder):
+            filename = os.path.join(self.folder, name)
+            if re.match(r'[0-9a-f]{16}_[0-9a-f]{16}\.npy(\.tmp)?$', name) and time.time() - os.path.getmtime(filename) > max_age:
+                try:
+                    os.remove(filename)
+                    deleted += 1
+                except OSError:  # e.g. in use by another experiment on Windows
+                    pass
+        return deleted
+
+    def __repr__(self):
+        return 'ColorCache(%s: %i palettes loaded, %i hits, %i misses)' % (self.folder, len(self._palettes), self.hits, self.misses)
+
+
+def main(args=None):
+    """
+    The command line interface. Currently only "bench"::
+
+        python -m ppc bench                     # run all benchmarks and compare to baseline
+        python -m ppc bench csv_writer --save   # run some and add them to the baseline
+        python -m ppc bench --import mybenchmarks  # also run benchmarks registered in mybenchmarks.py
+    """
+    import argparse
+    import importlib
+    parser = argparse.ArgumentParser(prog='python -m ppc', description='PsychoPy course helpers.')
+    commands = parser.add_subparsers(dest='command')
+    bench = commands.add_parser('bench', help='run registered benchmarks and detect regressions against a saved baseline')
+    bench.add_argument('names', nargs='*', help='benchmarks to run (prefixes). Default: all')
+    bench.add_argument('--save', action='store_true', help='add the results to the baseline')
+    bench.add_argument('--baseline', default='ppc_benchmarks.json', help='JSON file with baselines')
+    bench.add_argument('--import', dest='modules', action='append', default=[], help='module which registers more benchmarks')
+    options = parser.parse_args(args)
+
+    if options.command != 'bench':
+        parser.print_help()
+        return 2
+    for module in options.modules:
+        importlib.import_module(module)
+    results, regressions = run_benchmarks(options.names, options.baseline, options.save)
+    return 1 if regressions else 0
 
 
-def dkl2rgb(dkl):
-    """ takes a DKL color as input and returns the corresponding RGB color """
-    from numpy import array
-    from psychopy.misc import dkl2rgb
-    return dkl2rgb(array(dkl))
+if __name__ == '__main__':
+    import ppc  # so that modules imported with --import register in the same module as we run from
+    sys.exit(ppc.main())
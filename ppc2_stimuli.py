@@ -138,7 +138,7 @@ Exercise on visual size precision:
 	  be general across monitors? And/or general across fonts?
 """
 
-# Checking size in degrees. size = tan(angle_in_radians) * distance
+# Checking size in degrees. size = 2 * tan(angle_in_radians / 2) * distance
 import ppc
 print ppc.deg2cm(10, 65)
 print ppc.deg2cm(3, 60)
@@ -199,7 +199,7 @@ sound_pygame.play()
 core.wait(0.5)
 
 
-# winsound
+# ppc.Sound (sounddevice or winsound)
 sound_winsound = ppc.Sound('beep.wav')
 sound_winsound.play()
 core.wait(0.5)
@@ -92,7 +92,7 @@ duration = clock.getTime()      # Get duration just when blank screen has been p
 port.setData(0)             # Stop trigger
 
 # GOOD for audio:
-beep_winsound.play()  # using winsound, Windows only! Low latency if soundcard is set up properly
+beep_winsound.play()  # ppc.Sound decodes the file in advance. Low latency if soundcard is set up properly
 port.setData(15)
 core.wait(0.1)  #Duration of trigger
 port.setData(0)
@@ -132,18 +132,19 @@ for i in range(20):
 #    * there's no jitter in audio, visual or trigger onset.
 #    * frameInterval is measured precisely for the system
 
-frameInterval = 0.01667  # seconds
+frameInterval = ppc.frame_interval(win)  # seconds. Measured once for this computer and display mode, then loaded from cache
 visualDelay = 0.005  # seconds relative to trigger
 soundDelay = 0.007  # seconds relative to trigger
+scheduler = ppc.Scheduler()  # sleeps until just before each deadline, then waits precisely
 for i in range(20):
     win.flip()  # to lock clock timing to win.flip before frame 0
-    clock.reset()
+    scheduler.start()  # deadlines below are relative to this flip
     for frame in range(3):  # 50 ms on 60 Hz
         stim.draw()
 
         # sound initiated before flip
         if frame == 0:
-            while clock.getTime() < frameInterval + visualDelay - soundDelay: pass  # pause for just the right duration
+            scheduler.wait(frameInterval + visualDelay - soundDelay)  # pause for just the right duration
             beep_winsound.play()
 
         # The flip
@@ -151,12 +152,12 @@ for i in range(20):
 
         # trigger initiated after flip
         if frame == 0:
-            while clock.getTime() < frameInterval + visualDelay: pass  # let the trigger wait
+            scheduler.wait(soundDelay)  # let the trigger wait. Relative to the sound deadline
             port.setData(15)
             clock.reset()
 
     win.flip()
     port.setData(0)
-    while clock.getTime() < frameInterval*3: pass  # let the trigger wait
+    scheduler.wait(frameInterval*3)  # let the trigger wait. Relative to the trigger deadline
     duration = clock.getTime()  # this is approximate but usually accurate to below 0.1 ms
     core.wait(0.3)
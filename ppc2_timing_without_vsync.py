@@ -31,17 +31,20 @@ win = visual.Window(waitBlanking=False)
 
 # Hack for computers that don't wait for win.flip().
 # It's useful for development but don't it use for data collection!
-# Note: takes a total of 5 lines more than the above version.
-clock_frame = core.Clock()
-duration_frame = 0.01666667  # measure it physically or use ppc.getActualFrameRate()
+# Ticks are scheduled at absolute times, so delays don't add up over frames.
+# It sleeps most of the interval and only busy-waits the last bit before
+# each tick, so it doesn't occupy a whole CPU core.
+import ppc
+duration_frame = 0.01666667  # measure it physically or use ppc.frame_interval()
+scheduler = ppc.Scheduler(duration_frame)
 win.callOnFlip(clock.reset)
+scheduler.start()
 for frame in range(60):
     stim_grating.phase += 0.02
     stim_grating.draw()
 
-	# these three lines replaces the properly working win.flip()
-    while clock_frame.getTime() < duration_frame: pass  # wait for imaginary flip
-    clock_frame.reset()
+    scheduler.tick()  # wait for imaginary flip. Replaces the properly working win.flip()
     win.flip()
 win.flip()
 print clock.getTime()  # Actual duration
+scheduler.report()  # how late the imaginary flips were
@@ -135,8 +135,9 @@ TEXT_INSTRUCT = """
 
 # Import stuff
 import ppc
-print 'the physical diameter of the gabor patch should be', ppc.deg2cm(GABOR_SIZE, MON_DISTANCE), 'cm'
-print 'the physical size of the fixation cross should be', ppc.deg2cm(FIX_HEIGHT, MON_DISTANCE), 'cm'
+GEOMETRY = ppc.Geometry(MON_DISTANCE, MON_WIDTH, MON_SIZE)  # Fixed for the session. Converts between degrees, cm and pixels.
+print 'the physical diameter of the gabor patch should be', GEOMETRY.deg2cm(GABOR_SIZE), 'cm'
+print 'the physical size of the fixation cross should be', GEOMETRY.deg2cm(FIX_HEIGHT), 'cm'
 
 from psychopy import core, visual, gui, monitors, sound, event
 import random
@@ -160,7 +161,7 @@ win = visual.Window(monitor=my_monitor, units='deg', fullscr=True, allowGUI=Fals
 stim_gabor = visual.GratingStim(win, mask='gauss', sf=GABOR_SF, size=GABOR_SIZE)  # A gabor patch. Again, units are inherited.
 stim_fix = visual.TextStim(win, '+', height=FIX_HEIGHT)  # Fixation cross is just the character "+". Units are inherited from Window when not explicitly specified.
 stim_text = visual.TextStim(win, pos=MESSAGE_POS, height=MESSAGE_HEIGHT, wrapWidth=999)  # Message / question stimulus. Will be used to display instructions and questions.
-sound_success = sound.Sound('C', secs=0.1, octave=6)  # Obs, ppc.Sound() is much more accurate, but only works on windows.
+sound_success = sound.Sound('C', secs=0.1, octave=6)  # Obs, ppc.Sound() is much more accurate. It needs the sounddevice package except on windows.
 sound_fail = sound.Sound('C', secs=0.4, octave=4)
 
 
@@ -177,6 +178,7 @@ def ask(text='', keyList=None):
     stim_text.text = text
     stim_text.draw()
     time_flip = win.flip()  # time of core.monotonicClock.getTime() at flip
+    ppc.collect_idle()  # garbage collection postponed from the timing critical part. A good time since we're waiting anyway.
 
     # Halt everything and wait for (first) responses matching the keys given in the Q object.
     if keyList:
@@ -272,30 +274,32 @@ def run_condition(condition):
             ask(TEXT_BREAK)
 
         # ACTION: THIS IS THE TIMING CRITICAL PART
-        # Fixation cue
-        win.callOnFlip(clock.reset)
-        for frame in range(FRAMES_FIX):
-            stim_fix.draw()
-            win.flip()
-
-        # Stimulus
-        for frame in range(trial['duration']):
-            stim_gabor.draw()
-            stim_fix.draw()
-            win.flip()
-
-        # Mask
-        for frame in range(FRAMES_MASK):
-            for ori in ORIS.values():
-                stim_gabor.ori = ori
+        # ppc.critical postpones garbage collection (which can take several ms) to ask()
+        with ppc.critical(win):
+            # Fixation cue
+            win.callOnFlip(clock.reset)
+            for frame in range(FRAMES_FIX):
+                stim_fix.draw()
+                win.flip()
+
+            # Stimulus
+            for frame in range(trial['duration']):
                 stim_gabor.draw()
+                stim_fix.draw()
+                win.flip()
+
+            # Mask
+            for frame in range(FRAMES_MASK):
+                for ori in ORIS.values():
+                    stim_gabor.ori = ori
+                    stim_gabor.draw()
+                stim_fix.draw()
+                win.flip()
+
+            # Get actual duration at offset
             stim_fix.draw()
-            win.flip()
-
-        # Get actual duration at offset
-        stim_fix.draw()
-        win.flip()  # blank screen
-        trial['durationReal'] = clock.getTime()
+            win.flip()  # blank screen
+            trial['durationReal'] = clock.getTime()
 
         # END OF TIMING CRITICAL SECTION
         # Ask question and record responses.
@@ -313,6 +317,7 @@ def run_condition(condition):
  Now it's really simple. You simply execute things using the functions ask and
  run_condition. Here we order block types given input from dialogue box
 """
+ppc.collect_idle(freeze=True)  # everything made during setup stays. Don't let the garbage collector scan it again.
 ask()
 if V['condition'] == 'trueFix':
     run_condition('trueFix')
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of ppc.py. Run with python -m pytest. They run without psychopy, a
+monitor or a sound card.
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+import ppc
+
+
+# Unit conversions
+def test_scalar_and_array_conversions_agree():
+    angles = np.linspace(-30, 30, 1001)
+    for centered in (True, False):
+        scalar = [ppc.deg2pix(float(angle), 60, 50, 1024, centered) for angle in angles]
+        assert np.allclose(ppc.deg2pix(angles, 60, 50, 1024, centered), scalar)
+        assert np.allclose(ppc.deg2pix(list(angles), 60, 50, 1024, centered), scalar)
+        cm = [ppc.deg2cm(float(angle), 60, centered) for angle in angles]
+        assert np.allclose(ppc.deg2cm(angles, 60, centered), cm)
+        assert np.allclose(ppc.cm2deg(np.asarray(cm), 60, centered), [ppc.cm2deg(value, 60, centered) for value in cm])
+
+
+def test_conversions_round_trip():
+    angles = np.linspace(-60, 60, 1001)
+    for centered in (True, False):
+        assert np.allclose(ppc.cm2deg(ppc.deg2cm(angles, 60, centered), 60, centered), angles)
+        assert np.allclose(ppc.pix2deg(ppc.deg2pix(angles, 60, 50, 1024, centered), 60, 50, 1024, centered), angles)
+        assert ppc.pix2deg(ppc.deg2pix(5.0, 60, 50, 1024, centered), 60, 50, 1024, centered) == pytest.approx(5)
+    assert np.allclose(ppc.pix2cm(ppc.cm2pix(angles, 50, 1024), 50, 1024), angles)
+
+
+def test_centered_formula():
+    # centered=False is the old one-sided formula
+    for angle in (0.5, 5, 10, 20, 45):
+        assert ppc.deg2cm(angle, 60, centered=False) == pytest.approx(math.tan(math.radians(angle)) * 60)
+        assert ppc.deg2cm(angle, 60) == pytest.approx(2 * 60 * math.tan(math.radians(angle) / 2))
+    assert ppc.deg2cm(10, 60, centered=False) / ppc.deg2cm(10, 60) == pytest.approx(1.008, abs=0.001)  # 0.8% too large
+
+
+def test_geometry_matches_functions():
+    geometry = ppc.Geometry(60, 50, [1024, 768])
+    angles = np.linspace(-40, 40, 10001)
+    for centered in (True, False):
+        assert np.allclose(geometry.deg2pix(angles, centered), ppc.deg2pix(angles, 60, 50, 1024, centered), atol=0.001)
+        assert geometry.deg2pix(5.0, centered) == pytest.approx(ppc.deg2pix(5.0, 60, 50, 1024, centered))
+    assert np.allclose(geometry.deg2pix([150, -150]), ppc.deg2pix(np.array([150, -150]), 60, 50, 1024))  # outside the lookup table
+    mixed = np.array([np.nan, 5, np.inf, -150, -5])  # only some outside the lookup table
+    with np.errstate(invalid='ignore'):  # tan(inf)
+        assert np.allclose(geometry.deg2pix(mixed), ppc.deg2pix(mixed, 60, 50, 1024), equal_nan=True)
+    assert np.isnan(geometry.deg2pix(np.array(np.nan)))
+    with pytest.raises(AttributeError):
+        geometry.distance = 50
+
+
+# Scheduling
+def test_scheduler_tick_needs_an_interval():
+    scheduler = ppc.Scheduler()
+    with pytest.raises(ValueError):
+        scheduler.tick()
+    assert scheduler.wait(0.001) >= 0
+
+
+# Critical periods
+class _RecordingWindow(object):
+    """Records flip intervals like a psychopy Window, including skipping the first one after recording is turned on"""
+    def __init__(self, intervals):
+        self._intervals = iter(intervals)
+        self.frameIntervals = []
+        self.recordFrameIntervals = False
+        self._just_turned_on = False
+
+    def __setattr__(self, name, value):
+        if name == 'recordFrameIntervals' and value and not getattr(self, 'recordFrameIntervals', False):
+            object.__setattr__(self, '_just_turned_on', True)
+        object.__setattr__(self, name, value)
+
+    def flip(self):
+        interval = next(self._intervals)
+        if self.recordFrameIntervals:
+            if self._just_turned_on:
+                self._just_turned_on = False
+            else:
+                self.frameIntervals.append(interval)
+
+
+@pytest.mark.parametrize('recording', [False, True])
+def test_critical_keeps_the_first_interval_of_the_period(recording):
+    win = _RecordingWindow([0.0167, 0.0167, 0.050, 0.0167, 0.0167, 0.1])
+    win.recordFrameIntervals = recording
+    win.flip()  # the interval before the period
+    with ppc.critical(win, enabled=False) as period:
+        win.flip()  # ends the interval which started before the period
+        win.flip()  # the first interval in the period: a dropped frame
+        win.flip()
+    assert period.worst_interval == 0.050
+    assert win.recordFrameIntervals == recording
+
+
+# Data writers
+def _read_csv(filename):
+    import csv
+    with open(filename) as f:
+        return list(csv.reader(f))
+
+
+def test_threaded_csv_writer_rejects_bad_trials_in_write(tmp_path):
+    writer = ppc.csv_writer('p1', folder=str(tmp_path), column_order=['id'], threaded=True)
+    with pytest.raises(ValueError):
+        writer.write({'rt': 0.5})  # no id
+    for i in range(20):
+        writer.write({'id': i, 'rt': 0.5})
+    writer.write({'id': 20, 'rt': 0.5, 'late': 'x'})  # extra column
+    writer.close()
+    writer.close()  # again, e.g. by atexit
+
+    rows = _read_csv(writer.save_file)
+    assert rows[0] == ['id', 'rt'] and len(rows) == 22
+    assert _read_csv(writer._name + ' extra columns.csv') == [['row', 'column', 'value'], ['21', 'late', 'x']]
+
+
+def test_csv_writer_closes_files_when_the_writer_thread_failed(tmp_path):
+    writer = ppc.csv_writer('p1', folder=str(tmp_path), threaded=True, journal=True)
+    writer._background._write_batch = None  # any error on the writer thread
+    writer.write({'id': 1})
+    with pytest.raises(Exception):
+        writer.close()
+    assert writer._file.closed and writer._journal.closed
+    writer.close()  # doesn't raise again
+
+
+def _journaled_session(tmp_path, trials=10):
+    """A csv_writer session with a journal, and the trials written"""
+    writer = ppc.csv_writer('p1', folder=str(tmp_path), column_order=['id'], journal=True)
+    written = [{'id': 'p1', 'trial': i, 'rt': 0.5 + i} for i in range(trials)]
+    for trial in written:
+        writer.write(trial)
+    writer.close()
+    return writer, written
+
+
+def test_recover_stops_at_a_torn_record(tmp_path):
+    writer, written = _journaled_session(tmp_path)
+    journal = writer.save_file + '.journal'
+    with open(journal, 'rb') as f:
+        data = f.read()
+    with open(journal, 'wb') as f:
+        f.write(data[:-5])  # a crash in the middle of writing the last trial
+
+    rows = _read_csv(ppc.recover(writer.save_file))
+    assert rows[0] == ['id', 'trial', 'rt']  # from the second header record, with all columns
+    assert rows[1:] == [[trial['id'], str(trial['trial']), str(trial['rt'])] for trial in written[:-1]]
+    assert rows == _read_csv(writer.save_file)[:-1]
+
+
+def test_recover_stops_at_a_corrupt_record(tmp_path):
+    writer, written = _journaled_session(tmp_path)
+    journal = writer.save_file + '.journal'
+    with open(journal, 'rb') as f:
+        data = bytearray(f.read())
+    data[-3] ^= 0xff  # garbage in the last trial
+    with open(journal, 'wb') as f:
+        f.write(bytes(data))
+
+    output = str(tmp_path / 'recovered.csv')
+    assert ppc.recover(journal, output) == output
+    assert len(_read_csv(output)) == 1 + len(written) - 1
+
+
+def test_threaded_flush_writes_everything_so_far(tmp_path):
+    writer = ppc.csv_writer('p1', folder=str(tmp_path), threaded=True, sync_every=7)
+    for i in range(100):
+        writer.write({'i': i})
+    assert writer.flush() >= 0
+    assert len(_read_csv(writer.save_file)) == 101
+    assert writer.stats()['writes'] == 100
+    writer.close()
+
+
+def test_npy_writer_promotes_column_types(tmp_path):
+    writer = ppc.npy_writer('p1', folder=str(tmp_path), chunk_size=3)
+    trials = [{'flag': True, 'n': 1, 'text': 'a'}, {'flag': False, 'n': 2, 'text': 'b'}, {'flag': True, 'n': 3.5, 'text': 'c'},
+              {'flag': 1.5, 'n': 4, 'text': 5}, {'n': 5}]  # promoted in the next chunk, and missing values
+    for trial in trials:
+        writer.write(trial)
+    writer.close()
+
+    data = ppc.load_npy(writer.save_folder)
+    assert data['n'].dtype == np.float64 and list(data['n']) == [1, 2, 3.5, 4, 5]
+    assert data['flag'].dtype == np.float64 and list(data['flag'][:4]) == [1, 0, 1, 1.5] and np.isnan(data['flag'][4])
+    assert list(data['text']) == ['a', 'b', 'c', '5', '']
+    chunks = ppc.load_npy(writer.save_folder, concatenate=False)
+    assert [len(chunk) for chunk in chunks['n']] == [3, 2]
+
+
+def test_sqlite_writer_batches(tmp_path):
+    import sqlite3
+    database = str(tmp_path / 'data.sqlite')
+    writer = ppc.sqlite_writer(database, 'trials', batch_size=7)
+    for i in range(100):
+        writer.write({'i': i, 'value': np.float64(i) / 2})
+    writer.flush()
+    db = sqlite3.connect(database)  # another connection sees everything committed so far
+    assert db.execute('SELECT COUNT(*), SUM(value) FROM trials').fetchone() == (100, sum(range(100)) / 2.0)
+    writer.write({'i': 100, 'new': 'x'})  # a new column
+    writer.close()
+    assert db.execute('SELECT i, new FROM trials WHERE new IS NOT NULL').fetchall() == [(100, 'x')]
+    db.close()
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'xz'])
+def test_compressed_csv_only_contains_finished_blocks(tmp_path, compression):
+    import gzip
+    lzma = pytest.importorskip('lzma')
+    read = (gzip if compression == 'gzip' else lzma).open
+    writer = ppc.csv_writer('p1', folder=str(tmp_path), compression=compression, block_size=100)
+    for i in range(250):
+        writer.write({'i': i, 'rt': 0.5})
+    writer._background.wait()
+    with read(writer.save_file) as f:  # as after a crash: readable, with the first two blocks
+        assert len(f.read().splitlines()) == 1 + 200
+    writer.close()
+    with read(writer.save_file) as f:
+        assert f.read().decode('utf-8').splitlines()[-1] == '249,0.5'
+
+
+def test_sqlite_writer_rejects_bad_trials_in_write(tmp_path):
+    import sqlite3
+    database = str(tmp_path / 'data.sqlite')
+    writer = ppc.sqlite_writer(database, 'trials', session={'name': u'Lindel\xf8v'}, column_order=['condition'], batch_size=10)
+    for i in range(50):
+        writer.write({'condition': 'b', 'i': i})
+    with pytest.raises(ValueError):
+        writer.write({'i': 50})  # no condition
+    with pytest.raises(ValueError):
+        writer.write({'condition': 'b', '_session': 1})
+    writer.write({'condition': 'c', 'i': 51, 'text': u'bl\xe5'})
+    writer.close()
+
+    db = sqlite3.connect(database)
+    assert db.execute('SELECT COUNT(*) FROM trials').fetchone()[0] == 51
+    assert db.execute('SELECT text FROM trials WHERE condition = "c"').fetchone()[0] == u'bl\xe5'
+    assert db.execute('SELECT name FROM sessions JOIN trials ON trials._session = sessions._id').fetchone()[0] == u'Lindel\xf8v'
+    db.close()
+
+
+# Colors
+def test_color_cache(tmp_path):
+    import os
+    import time
+    folder = str(tmp_path)
+    palettes = [np.column_stack([np.zeros(100), np.linspace(0, 360, 100), np.full(100, value)]) for value in (0.2, 0.4, 0.6)]
+    colors = ppc.ColorCache(folder=folder, gamma=2.2, palettes=2)
+    for palette in palettes + palettes[::-1]:
+        assert np.allclose(colors.dkl2rgb(palette), ppc.dkl2rgb(palette, gamma=2.2))
+    assert len(colors._palettes) == 2  # bounded
+    assert (colors.hits, colors.misses) == (3, 3)  # two in memory, one from disk
+    assert ppc.ColorCache(folder=folder, gamma=2.2).dkl2rgb(palettes[0]).flags.writeable is False
+
+    for i in range(3):
+        assert np.allclose(colors.dkl2rgb([0, 45, 1]), ppc.dkl2rgb([0, 45, 1], gamma=2.2))
+    assert (colors.hits, colors.misses) == (5, 4)
+
+    files = sorted(os.listdir(folder))
+    assert len(files) == 3
+    old = time.time() - 3600
+    os.utime(os.path.join(folder, files[0]), (old, old))
+    open(os.path.join(folder, 'notes.txt'), 'w').close()  # not a cache file
+    assert colors.prune(max_age=60) == 1
+    assert sorted(os.listdir(folder)) == sorted(files[1:] + ['notes.txt'])
+
+
+# Frame rate
+def test_estimate_period_with_drops_and_jitter():
+    flip = ppc.SimulatedVSync(rate=60, drop=0.05, jitter=0.0001, seed=1)
+    result = ppc.getActualFrameRate(frames=600, flip=flip, verbose=False)
+    assert result.period == pytest.approx(1 / 60.0, rel=1e-4)
+    assert result.rate == pytest.approx(60, rel=1e-4)
+    assert result.dropped > 0
+    assert result.mean > result.period  # the average is inflated by drops; the period isn't
+
+
+def test_estimate_period_ignores_flips_which_did_not_wait():
+    flip = ppc.SimulatedVSync(rate=144, double=0.1, seed=2)
+    result = ppc.getActualFrameRate(frames=600, flip=flip, verbose=False)
+    assert result.period == pytest.approx(1 / 144.0, rel=1e-6)
+    assert len(result.doubled_frames) > 0
+
+
+def test_estimate_period_rejects_unsynced_flips():
+    with pytest.raises(ValueError):
+        ppc.estimate_period(np.arange(100) * 0.0001)  # 0.1 ms apart
+    with pytest.raises(ValueError):
+        ppc.estimate_period(np.cumsum(np.random.RandomState(3).uniform(0.005, 0.03, 100)))  # not locked to a period
+    with pytest.raises(ValueError):
+        ppc.estimate_period([0.0, 0.016, 0.033])  # too few
+
+
+def test_frame_rate_without_vsync():
+    for flip, frames in [(lambda: None, 200), (ppc.SimulatedVSync(double=0.98, seed=5), 200), (ppc.SimulatedVSync(), 5)]:
+        result = ppc.getActualFrameRate(frames=frames, flip=flip, verbose=False)
+        assert math.isnan(result.period) and math.isnan(result.rate)
+        assert len(result.intervals) == frames and result.max >= result.min
+        assert result.error in repr(result)
+
+
+def test_frame_interval_does_not_cache_without_vsync(tmp_path):
+    cache_file = str(tmp_path / 'frame_interval.json')
+    with pytest.raises(ValueError):
+        ppc.frame_interval(flip=lambda: None, frames=100, cache_file=cache_file)
+    assert not (tmp_path / 'frame_interval.json').exists()
+
+
+def test_frame_interval_is_cached(tmp_path):
+    cache_file = str(tmp_path / 'frame_interval.json')
+    flip = ppc.SimulatedVSync(rate=100, seed=4)
+    period = ppc.frame_interval(flip=flip, frames=100, cache_file=cache_file)
+    assert period == pytest.approx(0.01)
+    assert ppc.frame_interval(flip=ppc.SimulatedVSync(rate=100, seed=4), cache_file=cache_file) == period
+    assert ppc.frame_interval(flip=ppc.SimulatedVSync(rate=50), frames=100, cache_file=cache_file) == pytest.approx(0.02)  # another key
+
+
+# Sound
+def test_null_sound_records_beeps():
+    sound = ppc.Sound(backend='null', rate=8000)
+    sound.beep(1000, 0.1)
+    sound.beep(1000, 0.1)
+    assert len(sound.backend.played) == 2
+    start, samples = sound.backend.played[-1]
+    assert samples.shape == (800, 1)
+    assert np.abs(samples).max() <= 0.5
+    assert sound.last_call <= start
+
+
+def test_null_sound_plays_and_writes_files(tmp_path):
+    filename = str(tmp_path / 'beep.wav')
+    recorder = ppc.Sound(backend='null', rate=8000)
+    recorder.beep(440, 0.05)
+    recorder.backend.write(filename)
+
+    sound = ppc.Sound(filename, backend='null')
+    assert sound.rate == 8000
+    sound.play()
+    assert sound.backend.played[-1][1] is sound.samples
+    assert np.allclose(sound.samples, recorder.backend.played[-1][1], atol=1e-4)
+
+
+def test_play_without_file_raises():
+    sound = ppc.Sound(backend='null')
+    with pytest.raises(ValueError):
+        sound.play()
+    assert sound.last_call is None
+
+
+def test_sound_falls_back_when_a_backend_can_not_be_used(monkeypatch):
+    def no_library(rate, channels):
+        raise OSError('PortAudio library not found')
+
+    def not_installed(rate, channels):
+        raise ImportError('No module named winsound')
+    monkeypatch.setitem(ppc._sound_backends, 'sounddevice', no_library)
+    monkeypatch.setitem(ppc._sound_backends, 'winsound', not_installed)
+    with pytest.raises(ImportError) as error:
+        ppc.Sound(rate=12345)
+    assert 'PortAudio library not found' in str(error.value) and 'winsound' in str(error.value)
+
+    monkeypatch.setitem(ppc._sound_backends, 'winsound', ppc._NullOutput)
+    assert isinstance(ppc.Sound(rate=12345).backend, ppc._NullOutput)